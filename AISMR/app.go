@@ -29,6 +29,7 @@ type App struct {
 
 type AppConfig struct {
 	CacheStrategy string `json:"cacheStrategy"`
+	CacheBudgetMB int    `json:"cacheBudgetMB"`
 }
 
 type FileItem struct {
@@ -83,12 +84,21 @@ func (a *App) GetCacheInfo() map[string]interface{} {
 
 	if info, err := os.Stat(cacheDir); err == nil && info.IsDir() {
 		exists = true
-		filepath.Walk(cacheDir, func(_ string, info os.FileInfo, err error) error {
-			if !info.IsDir() {
-				size += info.Size()
-			}
-			return nil
-		})
+		// index.json is maintained by the pipeline; walk the tree only without it
+		var index struct {
+			Total *int64 `json:"total"`
+		}
+		data, err := os.ReadFile(filepath.Join(cacheDir, "index.json"))
+		if err == nil && json.Unmarshal(data, &index) == nil && index.Total != nil {
+			size = *index.Total
+		} else {
+			filepath.Walk(cacheDir, func(_ string, info os.FileInfo, err error) error {
+				if err == nil && !info.IsDir() {
+					size += info.Size()
+				}
+				return nil
+			})
+		}
 	}
 
 	return map[string]interface{}{
@@ -123,6 +133,7 @@ func (a *App) performTimeBasedCleanup() {
 	cwd, _ := os.Getwd()
 	cacheDir := filepath.Join(cwd, "core", "cache")
 
+	cleaned := false
 	entries, _ := os.ReadDir(cacheDir)
 	for _, entry := range entries {
 		if !entry.IsDir() {
@@ -132,8 +143,13 @@ func (a *App) performTimeBasedCleanup() {
 		if err == nil && info.ModTime().Before(threshold) {
 			os.RemoveAll(filepath.Join(cacheDir, entry.Name()))
 			a.log("Auto-cleaned old cache: " + entry.Name())
+			cleaned = true
 		}
 	}
+	if cleaned {
+		// The index total is stale now; the pipeline rebuilds it on its next run
+		os.Remove(filepath.Join(cacheDir, "index.json"))
+	}
 }
 
 func (a *App) ScanModels() []string {
@@ -269,6 +285,9 @@ func (a *App) RunScript(targetPath string) error {
 	a.stopFlag = false
 	a.mu.Unlock()
 
+	var cacheMu sync.Mutex
+	var cacheDirs []string
+
 	defer func() {
 		a.mu.Lock()
 		a.isRunning = false
@@ -276,13 +295,23 @@ func (a *App) RunScript(targetPath string) error {
 		a.mu.Unlock()
 
 		if a.config.CacheStrategy == "immediate" {
+			// Cache entries are keyed by content hash; run.py reports them on stdout
+			cacheMu.Lock()
+			dirs := append([]string(nil), cacheDirs...)
+			cacheMu.Unlock()
 			go func() {
-				cwd, _ := os.Getwd()
-				baseName := strings.TrimSuffix(filepath.Base(targetPath), filepath.Ext(targetPath))
-				cachePath := filepath.Join(cwd, "core", "cache", baseName)
-				if _, err := os.Stat(cachePath); err == nil {
-					os.RemoveAll(cachePath)
-					a.log("Auto-cleaned cache for: " + baseName)
+				cleaned := false
+				for _, cachePath := range dirs {
+					if _, err := os.Stat(cachePath); err == nil {
+						os.RemoveAll(cachePath)
+						a.log("Auto-cleaned cache: " + filepath.Base(cachePath))
+						cleaned = true
+					}
+				}
+				if cleaned {
+					// The index total is stale now; the pipeline rebuilds it on its next run
+					cwd, _ := os.Getwd()
+					os.Remove(filepath.Join(cwd, "core", "cache", "index.json"))
 				}
 			}()
 		}
@@ -322,6 +351,10 @@ func (a *App) RunScript(targetPath string) error {
 	newPath := fmt.Sprintf("%s%c%s%c%s%c%s", ffmpegPath, os.PathListSeparator, llamaPath, os.PathListSeparator, os.Getenv(pathKey), os.PathListSeparator, binPath)
 	env = append(env, fmt.Sprintf("%s=%s", pathKey, newPath))
 
+	if a.config.CacheBudgetMB > 0 {
+		env = append(env, fmt.Sprintf("CACHE_BUDGET_MB=%d", a.config.CacheBudgetMB))
+	}
+
 	// Set UTF-8 encoding for Python on Windows
 	if stdruntime.GOOS == "windows" {
 		env = append(env, "PYTHONIOENCODING=utf-8")
@@ -358,7 +391,18 @@ func (a *App) RunScript(targetPath string) error {
 	go func() {
 		defer wg.Done()
 		for scannerOut.Scan() {
-			a.log(scannerOut.Text())
+			line := scannerOut.Text()
+			if event, ok := strings.CutPrefix(line, "EVENT: "); ok {
+				// Structured telemetry goes to its own channel; the frontend shows a summary of it
+				runtime.EventsEmit(a.ctx, "pipeline-event", event)
+				continue
+			}
+			if dir, ok := strings.CutPrefix(line, "Cache directory: "); ok {
+				cacheMu.Lock()
+				cacheDirs = append(cacheDirs, strings.TrimSpace(dir))
+				cacheMu.Unlock()
+			}
+			a.log(line)
 		}
 	}()
 
@@ -8,10 +8,13 @@ if current_dir not in sys.path:
 import subprocess
 import shutil
 import json
-import glob
+import re
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from utils import get_cache_dir, PROMPTS_DIR, ASSETS_DIR, LocalLLM, load_asmr_dict, get_assets_context_path, get_assets_terms_path
-import pykakasi
+from utils import JobContext, get_qwen_model, get_assets_context_path, get_assets_terms_path, replace_file
+from stage_cache import digest
+import telemetry
 
 def check_ffmpeg():
     try:
@@ -19,17 +22,126 @@ def check_ffmpeg():
     except:
         sys.exit(1)
 
-def run_ffmpeg_normalization(input_path, output_path):
+PIPE_CHUNK = 1 << 20
+
+COMPAND_FILTER = "compand=attacks=0.05:decays=0.5:points=-90/-90|-60/-25|-20/-5|0/-0:gain=0"
+NORMALIZE_ENGINES = ("loudnorm", "fast")
+
+DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+def audio_inputs(ctx, engine=None):
+    engine = engine or os.environ.get("NORMALIZE_ENGINE", "loudnorm")
+    return {'source': ctx.input_hash, 'config': digest([engine, COMPAND_FILTER])}
+
+def source_duration(input_path):
+    """Container duration in seconds as ffmpeg reports it (no decoding), or None"""
+    try:
+        res = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-i", str(input_path)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = DURATION_PATTERN.search(res.stderr.decode("utf-8", "replace"))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def wav_duration(wav_path):
+    """Duration of a 16 kHz mono s16 WAV as written by the old normalization, or None"""
+    try:
+        with wave.open(str(wav_path), "rb") as w:
+            if (w.getframerate(), w.getnchannels(), w.getsampwidth()) != (16000, 1, 2):
+                return None
+            return w.getnframes() / 16000
+    except (OSError, EOFError, wave.Error):
+        return None
+
+def import_wav(wav_path, output_path):
+    """Copy the samples of a 16 kHz mono s16 WAV into the headerless PCM the stages read"""
+    part_path = str(output_path) + ".part"
+    with wave.open(str(wav_path), "rb") as w, open(part_path, "wb") as f:
+        while True:
+            frames = w.readframes(PIPE_CHUNK // 2)
+            if not frames: break
+            f.write(frames)
+    replace_file(part_path, output_path)
+
+def run_ffmpeg_normalization(input_path, output_path, engine=None):
+    """Decode the source in place and write normalized 16 kHz mono s16le PCM (no header).
+
+    The raw PCM is memory-mapped by the transcription stage, so the audio is
+    decoded exactly once. `engine` (default NORMALIZE_ENGINE, else loudnorm)
+    picks ffmpeg's loudnorm filter or the block-wise NumPy path in loudness.py.
+    """
     print("STATUS: Audio Normalization")
     sys.stdout.flush()
-    
-    compand_filter = "compand=attacks=0.05:decays=0.5:points=-90/-90|-60/-25|-20/-5|0/-0:gain=0"
-    af_filter = f"highpass=f=80,lowpass=f=8000,{compand_filter},loudnorm=I=-14:TP=-1.0:LRA=11"
+
+    engine = engine or os.environ.get("NORMALIZE_ENGINE", "loudnorm")
+    if engine == "fast":
+        run_fast_normalization(input_path, output_path)
+        return
+
+    af_filter = f"highpass=f=80,lowpass=f=8000,{COMPAND_FILTER},loudnorm=I=-14:TP=-1.0:LRA=11"
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "error", "-i", str(input_path), "-af", af_filter,
+        "-ar", "16000", "-ac", "1", "-f", "s16le", "pipe:1"
+    ]
+    part_path = str(output_path) + ".part"
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(part_path, "wb") as f:
+        shutil.copyfileobj(proc.stdout, f, PIPE_CHUNK)
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        os.remove(part_path)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    replace_file(part_path, output_path)
+
+def run_fast_normalization(input_path, output_path):
+    """Resample to 16 kHz mono first, compand in ffmpeg, then gain and limit in NumPy.
+
+    loudnorm in dynamic mode works at 192 kHz internally, which dominates the
+    prepare step on long tracks. Here every filter runs at 16 kHz: ffmpeg emits
+    float32 samples that are metered (BS.1770) while they are captured, and a
+    second pass over the capture applies the gain to -14 LUFS with a -1 dBFS
+    peak limiter. The resampler already band-limits to 8 kHz, so no lowpass.
+    """
+    import numpy as np
+    import loudness
+
+    af_filter = f"aformat=channel_layouts=mono,aresample=16000,highpass=f=80,{COMPAND_FILTER}"
     cmd = [
-        "ffmpeg", "-y", "-i", str(input_path), "-af", af_filter,
-        "-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le", str(output_path)
+        "ffmpeg", "-nostdin", "-v", "error", "-i", str(input_path), "-af", af_filter,
+        "-ar", "16000", "-ac", "1", "-f", "f32le", "pipe:1"
     ]
-    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    float_path = str(output_path) + ".f32.part"
+    part_path = str(output_path) + ".part"
+    meter = loudness.LoudnessMeter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        with open(float_path, "wb") as f:
+            leftover = b""
+            while True:
+                data = proc.stdout.read(PIPE_CHUNK)
+                if not data: break
+                f.write(data)
+                data = leftover + data
+                usable = len(data) // 4 * 4
+                leftover = data[usable:]
+                meter.feed(np.frombuffer(data[:usable], dtype=np.float32))
+        meter.finish()
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+        with open(part_path, "wb") as f:
+            measured, gain_db = loudness.write_normalized(float_path, f, meter)
+        if measured is not None:
+            print(f"Loudness: {measured:.1f} LUFS, gain {gain_db:+.1f} dB", flush=True)
+        replace_file(part_path, output_path)
+    finally:
+        for path in (float_path, part_path):
+            if os.path.exists(path):
+                os.remove(path)
 
 def read_text_file_robust(file_path):
     encodings = ['utf-8', 'shift_jis', 'cp932', 'euc-jp', 'gbk']
@@ -41,7 +153,78 @@ def read_text_file_robust(file_path):
         except: continue
     return ""
 
-def analyze_context(content, prompt_file_name):
+# Context analysis and term extraction run at once, one Qwen slot each
+PREPARE_SLOTS = 2
+# ReadMe text per request; longer files are mapped chunk by chunk and merged
+CHUNK_CHARS = 4000
+
+# llama-server turns these into a grammar, so replies always parse
+CONTEXT_SCHEMA = {
+    "type": "object",
+    "properties": {"summary": {"type": "string"}, "style": {"type": "string"}, "whisper_keywords": {"type": "string"}},
+    "required": ["summary", "style", "whisper_keywords"]
+}
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {"summary": {"type": "string"}, "style": {"type": "string"}},
+    "required": ["summary", "style"]
+}
+TERMS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"term": {"type": "string"}, "type": {"type": "string", "enum": ["noun", "verb", "adj"]}},
+        "required": ["term", "type"]
+    }
+}
+
+MERGE_CONTEXT_PROMPT = (
+    "You are an ASMR script analyzer. The input is a JSON list of 'summary'/'style' notes, one per part of the same script.\n"
+    "Merge them into one JSON object with keys 'summary' and 'style' that describes the whole work."
+)
+
+def split_content(content, size=CHUNK_CHARS):
+    """Pieces of at most `size` characters, cut at line ends where possible"""
+    chunks = []
+    current = ""
+    for line in content.splitlines(keepends=True):
+        while len(line) > size:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:size])
+            line = line[size:]
+        if len(current) + len(line) > size:
+            chunks.append(current)
+            current = ""
+        current += line
+    if current.strip():
+        chunks.append(current)
+    return [c for c in chunks if c.strip()]
+
+def ask_json(llm, system_prompt, content, schema, max_tokens):
+    """Schema-constrained completion, parsed; None if the reply was cut off at max_tokens"""
+    full_prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n<|im_start|>user\n{content}<|im_end|>\n<|im_start|>assistant\n"
+    response = llm.completion(full_prompt, temperature=0.1, max_tokens=max_tokens, json_schema=schema)
+    try:
+        return json.loads(response)
+    except ValueError:
+        return None
+
+def merge_context(llm, parts):
+    """One context from the per-chunk ones: keywords are joined, summary and style merged by Qwen"""
+    if len(parts) == 1:
+        return parts[0]
+    keywords = []
+    for part in parts:
+        kw = part.get("whisper_keywords", "")
+        keywords.append(", ".join(kw) if isinstance(kw, list) else kw)
+    notes = [{"summary": p.get("summary", ""), "style": p.get("style", "")} for p in parts]
+    merged = ask_json(llm, MERGE_CONTEXT_PROMPT, json.dumps(notes, ensure_ascii=False), SUMMARY_SCHEMA, 512) or notes[0]
+    merged["whisper_keywords"] = ", ".join(k for k in keywords if k)
+    return merged
+
+def analyze_context(content, prompt_file_name, ctx):
     print("STATUS: Context Analysis")
     sys.stdout.flush()
 
@@ -56,8 +239,6 @@ def analyze_context(content, prompt_file_name):
         return
 
     try:
-        port = int(os.environ.get("LLM_PORT", 8080))
-        llm = LocalLLM(port=port)
         system_prompt = (
             "You are an ASMR script analyzer. Extract metadata for translation and speech recognition.\n"
             "Output strictly valid JSON with keys: 'summary', 'style', 'whisper_keywords'.\n"
@@ -75,15 +256,11 @@ def analyze_context(content, prompt_file_name):
             "   - Real names, Dates, Prices, URL, 'ASMR', 'Binaural', CV names, Circle names\n"
             "4. Focus on terms that are RARE in everyday Japanese but important for this content."
         )
-        full_prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n<|im_start|>user\n{content[:4000]}<|im_end|>\n<|im_start|>assistant\n"
-        response = llm.completion(full_prompt, temperature=0.1, max_tokens=1024)
-        
-        try:
-            start = response.find('{')
-            end = response.rfind('}') + 1
-            data = json.loads(response[start:end])
-        except:
-            data = default_data
+        with ctx.llm(get_qwen_model(), PREPARE_SLOTS) as llm:
+            parts = [ask_json(llm, system_prompt, chunk, CONTEXT_SCHEMA, 1024) for chunk in split_content(content)]
+            parts = [p for p in parts if p]
+            data = merge_context(llm, parts) if parts else default_data
+            telemetry.llm_usage(ctx, "_0_prepare.py:context", llm)
 
         blacklist = ["CV", "Voice", "Circle", "Track", "http", "DL", "版本", "作者", "声优", "発売", "価格", "バイノーラル", "立体音響", "ASMR", "様", "出演"]
 
@@ -92,8 +269,7 @@ def analyze_context(content, prompt_file_name):
 
         common_terms = set()
         try:
-            dict_data = load_asmr_dict()
-            for item in dict_data:
+            for item in ctx.asmr_dict:
                 common_terms.add(item['term'])
         except: pass
 
@@ -124,10 +300,11 @@ def analyze_context(content, prompt_file_name):
         with open(context_file, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
             
-    except:
+    except Exception:
+        # A server that failed to start (SystemExit) fails the stage instead
         with open(context_file, "w", encoding="utf-8") as f: json.dump(default_data, f)
 
-def extract_terms(content, prompt_file_name):
+def extract_terms(content, prompt_file_name, ctx):
     """Extract terms for temporary dictionary"""
     print("STATUS: Extracting Terms")
     sys.stdout.flush()
@@ -141,8 +318,7 @@ def extract_terms(content, prompt_file_name):
     # Load existing global dictionary for deduplication
     existing_terms = set()
     try:
-        dict_data = load_asmr_dict()
-        for item in dict_data:
+        for item in ctx.asmr_dict:
             existing_terms.add(item['term'])
     except:
         pass
@@ -156,8 +332,6 @@ def extract_terms(content, prompt_file_name):
         return
 
     try:
-        port = int(os.environ.get("LLM_PORT", 8080))
-        llm = LocalLLM(port=port)
         system_prompt = (
             "你是日语成人向ASMR术语提取专家。只提取在日常日语中罕见但在成人向内容中重要的专有术语。\n"
             "输出格式：JSON数组 [{\"term\": \"日文术语\", \"type\": \"词性\"}]\n"
@@ -181,19 +355,16 @@ def extract_terms(content, prompt_file_name):
             "\n注意：type只需填noun/verb/adj其中之一，大部分是noun"
         )
 
-        full_prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n<|im_start|>user\n{content[:4000]}<|im_end|>\n<|im_start|>assistant\n"
-        response = llm.completion(full_prompt, temperature=0.1, max_tokens=2048)
-
-        # Parse JSON array
-        try:
-            start = response.find('[')
-            end = response.rfind(']') + 1
-            if start >= 0 and end > start:
-                extracted_terms = json.loads(response[start:end])
-            else:
-                extracted_terms = []
-        except:
-            extracted_terms = []
+        # Terms of every chunk, first occurrence wins
+        extracted_terms = []
+        seen_terms = set()
+        with ctx.llm(get_qwen_model(), PREPARE_SLOTS) as llm:
+            for chunk in split_content(content):
+                for term_obj in ask_json(llm, system_prompt, chunk, TERMS_SCHEMA, 2048) or []:
+                    if isinstance(term_obj, dict) and term_obj.get('term') not in seen_terms:
+                        seen_terms.add(term_obj.get('term'))
+                        extracted_terms.append(term_obj)
+            telemetry.llm_usage(ctx, "_0_prepare.py:terms", llm)
 
         # Filter and validate
         blacklist = ["CV", "Voice", "Circle", "Track", "http", "DL", "版本", "作者",
@@ -219,12 +390,9 @@ def extract_terms(content, prompt_file_name):
             if term in common_words:
                 continue
 
-            # Generate reading using pykakasi
+            # Generate reading using pykakasi (memoized across terms and runs)
             try:
-                kks = pykakasi.kakasi()
-                result = kks.convert(term)
-                reading = ''.join([item['hepburn'] for item in result])
-                term_obj['reading'] = reading.lower()
+                term_obj['reading'] = ctx.readings.reading(term)
             except:
                 term_obj['reading'] = ""
 
@@ -241,6 +409,8 @@ def extract_terms(content, prompt_file_name):
 
             filtered_terms.append(filtered_term)
 
+        ctx.readings.flush()
+
         # Save to file
         with open(terms_path, "w", encoding="utf-8") as f:
             json.dump(filtered_terms, f, ensure_ascii=False, indent=2)
@@ -250,48 +420,45 @@ def extract_terms(content, prompt_file_name):
         with open(terms_path, "w", encoding="utf-8") as f:
             json.dump(default_terms, f, ensure_ascii=False, indent=2)
 
-def process_audio(input_file):
-    check_ffmpeg()
+def load_prompt_content(ctx):
+    if not ctx.prompt_file:
+        return ""
+    return read_text_file_robust(ctx.prompt_file)
+
+def process_audio(input_file, ctx=None, normalize=True):
+    """Normalize the audio (unless `normalize` is off) and make sure context and terms exist"""
+    if ctx is None:
+        ctx = JobContext(input_file)
+    ctx.cached("ffmpeg_checked", lambda: check_ffmpeg() or True)
 
     if not os.path.exists(input_file):
         print(f"ERROR: Input file not found: {input_file}", flush=True)
         sys.exit(1)
 
-    input_path = Path(input_file)
-    cache_dir = get_cache_dir(input_file)
-    final_wav = Path(cache_dir) / "audio_16k_norm.wav"
-
-    if not final_wav.exists() or final_wav.stat().st_size == 0:
-        temp_wav = Path(cache_dir) / "temp.wav"
+    inputs = audio_inputs(ctx)
+    if normalize and not ctx.stages.is_fresh("audio", ctx.audio_path, inputs):
         try:
-            shutil.copy(input_path, temp_wav)
-            run_ffmpeg_normalization(temp_wav, final_wav)
+            run_ffmpeg_normalization(input_file, Path(ctx.audio_path))
         except Exception as e:
             print(f"ERROR: Audio processing failed: {e}", flush=True)
             sys.exit(1)
-        finally:
-            if temp_wav.exists():
-                os.remove(temp_wav)
-
-    content = ""
-    prompt_file_name = "default"
-    if os.path.exists(PROMPTS_DIR):
-        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
-        if txt_files:
-            content = read_text_file_robust(txt_files[0])
-            prompt_file_name = os.path.basename(txt_files[0])
-    if not content and os.path.exists("ReadMe.txt"):
-        content = read_text_file_robust("ReadMe.txt")
-        prompt_file_name = "ReadMe.txt"
+        # The PCM is identified by what produced it; hashing it would cost as much as decoding
+        ctx.stages.record("audio", ctx.audio_path, inputs, output=digest(inputs))
 
+    prompt_file_name = ctx.prompt_file_name
     context_path = get_assets_context_path(prompt_file_name)
     terms_path = get_assets_terms_path(prompt_file_name)
 
     if os.path.exists(context_path) and os.path.exists(terms_path):
         print("STATUS: Using existing context and terms", flush=True)
     else:
-        analyze_context(content, prompt_file_name)
-        extract_terms(content, prompt_file_name)
+        content = ctx.cached("prompt_content", lambda: load_prompt_content(ctx))
+        # Both share one Qwen server, each on its own slot
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            tasks = [pool.submit(analyze_context, content, prompt_file_name, ctx),
+                     pool.submit(extract_terms, content, prompt_file_name, ctx)]
+            for task in tasks:
+                task.result()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2: sys.exit(1)
@@ -3,22 +3,50 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import json
 import re
-import glob
-from faster_whisper import WhisperModel
-from utils import WHISPER_DIR, get_cache_dir, load_asmr_dict, get_assets_context_path, PROMPTS_DIR
+import time
+import multiprocessing
+from types import SimpleNamespace
+from utils import WHISPER_DIR, JobContext, get_assets_context_path, replace_file
+from stage_cache import digest
+from text_kernels import fold_repetitions
+from subtitles import Cue, CueWriter, format_srt_time, to_ms
+import telemetry
 
 MODEL_SIZE = "large-v2"
 COMPUTE_TYPE = "int8_float16"
 
-HALLUCINATION_BLACKLIST = ["Subtitle", "Caption", "Amara", "999999", "視聴ありがとう", "チャンネル登録", "高評価", "転載禁止", "字幕", "作成"]
+# Decode profiles, chosen with --whisper-profile / WHISPER_PROFILE. "accurate"
+# is the original sequential beam-5 decode. A batch_size runs the decode through
+# BatchedInferencePipeline, which batches 30 s windows of the VAD speech regions.
+# cpu_threads 0 shares all cores out between num_workers.
+PROFILES = {
+    "fast": dict(device="cuda", compute_type=COMPUTE_TYPE, batch_size=16, beam_size=1, word_timestamps=False),
+    "balanced": dict(device="cuda", compute_type=COMPUTE_TYPE, batch_size=8, beam_size=3, word_timestamps=False),
+    "accurate": dict(device="cuda", compute_type=COMPUTE_TYPE, batch_size=0, beam_size=5, word_timestamps=True),
+    "cpu": dict(device="cpu", compute_type="int8", batch_size=4, beam_size=1, word_timestamps=False, cpu_threads=0, num_workers=1),
+}
+DEFAULT_PROFILE = "accurate"
+
+# Chunked CPU mode window layout (enabled by WHISPER_CHUNK_WORKERS > 0)
+CHUNK_SECONDS = 300
+CHUNK_OVERLAP_SECONDS = 5
+CUT_SEARCH_SECONDS = 15
+# 100 ms frames converted to float at a time when looking for quiet cut points (60 s)
+ENERGY_BLOCK_FRAMES = 600
+SAMPLE_RATE = 16000
 
-def format_timestamp(seconds):
-    milliseconds = int((seconds % 1) * 1000)
-    seconds = int(seconds)
-    return f"{seconds//3600:02d}:{(seconds%3600)//60:02d}:{seconds%60:02d},{milliseconds:03d}"
+TRANSCRIBE_OPTIONS = dict(
+    language="ja",
+    beam_size=5,
+    vad_filter=False,
+    no_speech_threshold=None,
+    log_prob_threshold=None,
+    word_timestamps=True,
+    condition_on_previous_text=False,
+    repetition_penalty=1.1
+)
 
-def fold_repetitions(text):
-    return re.sub(r'(.+?)\1{2,}', r'\1...', text)
+HALLUCINATION_BLACKLIST = ["Subtitle", "Caption", "Amara", "999999", "視聴ありがとう", "チャンネル登録", "高評価", "転載禁止", "字幕", "作成"]
 
 def is_hallucination(text, compression_ratio):
     for bad in HALLUCINATION_BLACKLIST:
@@ -27,25 +55,25 @@ def is_hallucination(text, compression_ratio):
     return False
 
 def split_by_sentence_end(segment):
+    """Cues of one segment, split after sentence ends with the time shared out by length"""
     text = segment.text.strip().replace(" ", "").replace("　", "")
     text = fold_repetitions(text)
     if not text: return []
-    
+
+    start, end = to_ms(segment.start), to_ms(segment.end)
     parts = re.split(r'(?<=[。！？])', text)
     parts = [p for p in parts if p]
     if len(parts) <= 1:
-        return [{'start': segment.start, 'end': segment.end, 'text': text}]
-    
+        return [Cue(start, end, text)]
+
     results = []
-    duration = segment.end - segment.start
+    duration = end - start
     total_len = len(text)
-    current_start = segment.start
-    
+    pos = 0
     for p in parts:
-        part_ratio = len(p) / total_len
-        part_duration = duration * part_ratio
-        results.append({'start': current_start, 'end': current_start + part_duration, 'text': p})
-        current_start += part_duration
+        part_start = start + duration * pos // total_len
+        pos += len(p)
+        results.append(Cue(part_start, start + duration * pos // total_len, p))
     return results
 
 def is_prompt_mirror(text, prompt):
@@ -53,19 +81,11 @@ def is_prompt_mirror(text, prompt):
     match_count = sum(1 for k in keywords if k in text)
     return match_count >= 3 and len(text) < sum(len(k) for k in keywords) * 2
 
-def build_smart_prompt(input_file):
+def build_smart_prompt(ctx):
     base_prompt = "这是、男性向けのASMR音声作品です。"
     keywords = []
 
-    prompt_file_name = "default.txt"
-    if os.path.exists(PROMPTS_DIR):
-        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
-        if txt_files:
-            prompt_file_name = os.path.basename(txt_files[0])
-    elif os.path.exists("ReadMe.txt"):
-        prompt_file_name = "ReadMe.txt"
-
-    context_file = get_assets_context_path(prompt_file_name)
+    context_file = get_assets_context_path(ctx.prompt_file_name)
     if os.path.exists(context_file):
         try:
             with open(context_file, 'r', encoding='utf-8') as f:
@@ -76,8 +96,7 @@ def build_smart_prompt(input_file):
         except: pass
 
     try:
-        common_data = load_asmr_dict()
-        for item in common_data:
+        for item in ctx.asmr_dict:
             term = item.get('term')
             if term and term not in keywords:
                 keywords.append(term)
@@ -89,68 +108,249 @@ def build_smart_prompt(input_file):
 
     return prompt_str[:220]
 
-def main():
-    if len(sys.argv) < 2: sys.exit(1)
-    input_file = sys.argv[1]
+def active_profile():
+    """(name, settings) of the decode profile selected by WHISPER_PROFILE"""
+    name = os.environ.get("WHISPER_PROFILE", DEFAULT_PROFILE)
+    if name not in PROFILES:
+        print(f"Unknown Whisper profile {name!r}, using {DEFAULT_PROFILE}", flush=True)
+        name = DEFAULT_PROFILE
+    return name, PROFILES[name]
 
-    if not os.path.exists(input_file):
-        print(f"ERROR: Input file not found: {input_file}", flush=True)
-        sys.exit(1)
+def decode_options(profile, batched):
+    options = dict(TRANSCRIBE_OPTIONS, beam_size=profile["beam_size"], word_timestamps=profile["word_timestamps"])
+    if batched:
+        # Batched decoding only runs on VAD speech regions
+        options["vad_filter"] = True
+    return options
 
-    cache_dir = get_cache_dir(input_file)
-    audio_path = os.path.join(cache_dir, "audio_16k_norm.wav")
-    output_file = os.path.join(cache_dir, "raw.srt")
+def load_model(profile):
+    from faster_whisper import WhisperModel, BatchedInferencePipeline
+    print("STATUS: Loading Whisper Model", flush=True)
+    kwargs = {}
+    if profile["device"] == "cpu":
+        workers = profile.get("num_workers", 1)
+        kwargs = dict(cpu_threads=profile.get("cpu_threads") or max(1, (os.cpu_count() or 1) // workers), num_workers=workers)
+    model = WhisperModel(MODEL_SIZE, device=profile["device"], compute_type=profile["compute_type"], download_root=WHISPER_DIR, **kwargs)
+    return BatchedInferencePipeline(model=model) if profile["batch_size"] else model
 
-    if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-        sys.exit(0)
+def map_pcm(audio_path):
+    """The prepared 16 kHz s16le PCM file as a read-only int16 memmap"""
+    import numpy as np
+    return np.memmap(audio_path, dtype=np.int16, mode="r")
+
+def load_pcm(audio_path, start=0, count=None):
+    """Samples of the prepared 16 kHz s16le PCM file as float32 in [-1, 1].
+
+    The file is memory-mapped, so only the requested range is read.
+    """
+    import numpy as np
+    pcm = map_pcm(audio_path)
+    end = len(pcm) if count is None else start + count
+    return pcm[start:end].astype(np.float32) / 32768.0
+
+def frame_energy(pcm, frame):
+    """RMS of every `frame` int16 samples, converted ENERGY_BLOCK_FRAMES frames at a time"""
+    import numpy as np
+    n_frames = len(pcm) // frame
+    energy = np.empty(n_frames, dtype=np.float32)
+    for i in range(0, n_frames, ENERGY_BLOCK_FRAMES):
+        j = min(i + ENERGY_BLOCK_FRAMES, n_frames)
+        block = pcm[i * frame:j * frame].astype(np.float32).reshape(j - i, frame) / 32768.0
+        energy[i:j] = np.sqrt(np.mean(block ** 2, axis=1))
+    return energy
+
+def find_cut_points(pcm, sr=SAMPLE_RATE):
+    """Sample positions that split int16 `pcm` into ~CHUNK_SECONDS pieces at the quietest 100 ms nearby"""
+    import numpy as np
+    frame = sr // 10
+    n_frames = len(pcm) // frame
+    if n_frames == 0:
+        return [0, len(pcm)]
+    energy = frame_energy(pcm, frame)
+
+    cuts = [0]
+    step = CHUNK_SECONDS * 10
+    search = CUT_SEARCH_SECONDS * 10
+    target = step
+    while target + step // 2 < n_frames:
+        lo, hi = max(target - search, 1), min(target + search, n_frames)
+        quietest = lo + int(np.argmin(energy[lo:hi]))
+        cuts.append(quietest * frame)
+        target = quietest + step
+    cuts.append(len(pcm))
+    return cuts
+
+def _init_chunk_worker(cpu_threads, options):
+    global _chunk_model, _chunk_options
+    from faster_whisper import WhisperModel
+    _chunk_options = options
+    _chunk_model = WhisperModel(MODEL_SIZE, device="cpu", compute_type="int8", cpu_threads=cpu_threads, download_root=WHISPER_DIR)
+
+def _transcribe_window(job):
+    """Decode one window and keep the segments whose midpoint lies in its core [cut_start, cut_end)"""
+    audio_path, win_start, win_end, cut_start, cut_end, initial_prompt = job
+    audio = load_pcm(audio_path, win_start, win_end - win_start)
+    segments, _ = _chunk_model.transcribe(audio, initial_prompt=initial_prompt, **_chunk_options)
+    offset = win_start / SAMPLE_RATE
+    kept = []
+    for s in segments:
+        start, end = s.start + offset, s.end + offset
+        mid = (start + end) / 2 * SAMPLE_RATE
+        if cut_start <= mid < cut_end:
+            kept.append(dict(start=start, end=end, text=s.text, compression_ratio=s.compression_ratio, avg_logprob=s.avg_logprob))
+    return kept
+
+def transcribe_chunked(audio_path, initial_prompt, workers, options):
+    """Yield segments in order from overlapping windows decoded by a pool of CPU models.
+
+    Since decoding does not condition on previous text, windows are independent.
+    Each window is padded by CHUNK_OVERLAP_SECONDS on both sides and a segment is
+    kept only by the window whose core contains its midpoint, which removes the
+    duplicates from the overlap.
+    """
+    # Cut points come from the int16 memmap; each worker converts only its own window
+    pcm = map_pcm(audio_path)
+    cuts = find_cut_points(pcm)
+    total = len(pcm)
+    del pcm
+
+    pad = CHUNK_OVERLAP_SECONDS * SAMPLE_RATE
+    jobs = []
+    for cut_start, cut_end in zip(cuts, cuts[1:]):
+        jobs.append((audio_path, max(0, cut_start - pad), min(total, cut_end + pad), cut_start, cut_end, initial_prompt))
+
+    workers = max(1, min(workers, len(jobs)))
+    cpu_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"STATUS: Transcribing Audio ({len(jobs)} chunks on {workers} CPU workers)", flush=True)
+
+    with multiprocessing.get_context("spawn").Pool(workers, initializer=_init_chunk_worker, initargs=(cpu_threads, options)) as pool:
+        for kept in pool.imap(_transcribe_window, jobs):
+            for seg in kept:
+                yield SimpleNamespace(**seg)
+
+def transcription_inputs(ctx):
+    """Manifest inputs of raw.jsonl.
+
+    The initial prompt is only a hint and is left out on purpose, so that a
+    dictionary edit re-runs correction onwards instead of the whole decode.
+    """
+    _, profile = active_profile()
+    if int(os.environ.get("WHISPER_CHUNK_WORKERS", 0)) > 0:
+        # Chunk workers decode sequentially on CPU with the profile's beam settings
+        options = decode_options(profile, False)
+        decoder = ["cpu", "int8", CHUNK_SECONDS, CHUNK_OVERLAP_SECONDS]
+    else:
+        options = decode_options(profile, profile["batch_size"])
+        decoder = [profile["device"], profile["compute_type"]]
+        if profile["batch_size"]:
+            decoder.append(["batched", profile["batch_size"]])
+    return {'audio': ctx.stages.output_id("audio"), 'config': digest([MODEL_SIZE, decoder, options])}
+
+def check_job(ctx):
+    """Return (audio_path, output_file, inputs) for a job, or None when raw.jsonl is up to date"""
+    if not os.path.exists(ctx.input_file):
+        raise FileNotFoundError(f"Input file not found: {ctx.input_file}")
+
+    audio_path = ctx.audio_path
+    output_file = ctx.raw_path
+    inputs = transcription_inputs(ctx)
+
+    if ctx.stages.is_fresh("transcribe", output_file, inputs):
+        return None
 
     if not os.path.exists(audio_path):
-        print(f"ERROR: Audio file not found: {audio_path}", flush=True)
-        sys.exit(1)
+        raise FileNotFoundError(f"Audio file not found: {audio_path}")
+    return audio_path, output_file, inputs
 
-    initial_prompt = build_smart_prompt(input_file)
+def transcribe_file(ctx, audio_path, output_file, inputs):
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    initial_prompt = build_smart_prompt(ctx)
 
-    print("STATUS: Loading Whisper Model", flush=True)
-    model = WhisperModel(MODEL_SIZE, device="cuda", compute_type=COMPUTE_TYPE, download_root=WHISPER_DIR)
-
-    print("STATUS: Transcribing Audio", flush=True)
-    segments, info = model.transcribe(
-        audio_path,
-        language="ja",
-        beam_size=5,
-        initial_prompt=initial_prompt,
-        vad_filter=False,
-        no_speech_threshold=None,
-        log_prob_threshold=None,
-        word_timestamps=True,
-        condition_on_previous_text=False,
-        repetition_penalty=1.1
-    )
-    
-    final_srt_entries = []
+    profile_name, profile = active_profile()
+    chunk_workers = int(os.environ.get("WHISPER_CHUNK_WORKERS", 0))
+    if chunk_workers > 0:
+        segments = transcribe_chunked(audio_path, initial_prompt, chunk_workers, decode_options(profile, False))
+    else:
+        model = ctx.cached(f"whisper_model_{profile_name}", lambda: load_model(profile))
+        print(f"Whisper profile: {profile_name}", flush=True)
+        print("STATUS: Transcribing Audio", flush=True)
+        options = decode_options(profile, profile["batch_size"])
+        if profile["batch_size"]:
+            options["batch_size"] = profile["batch_size"]
+        segments, info = model.transcribe(load_pcm(audio_path), initial_prompt=initial_prompt, **options)
     
-    for segment in segments:
-        text = segment.text.strip().replace(" ", "").replace("　", "")
-        text = fold_repetitions(text)
-        
-        if len(text) < 1: continue
-        if is_prompt_mirror(text, initial_prompt): continue
-        if is_hallucination(text, segment.compression_ratio): continue
-        if segment.avg_logprob < -1.0 and len(text) < 5: continue
-
-        print(f"Processing: {format_timestamp(segment.start)} -> {format_timestamp(segment.end)}", flush=True)
-
-        split_results = split_by_sentence_end(segment)
-        for sub in split_results:
-            final_srt_entries.append(sub)
-            
-    with open(output_file, "w", encoding="utf-8") as f:
-        for i, entry in enumerate(final_srt_entries):
-            f.write(f"{i+1}\n")
-            f.write(f"{format_timestamp(entry['start'])} --> {format_timestamp(entry['end'])}\n")
-            f.write(f"{entry['text']}\n\n")
+    # Cues are flushed to raw.jsonl.part as segments finish so later stages can
+    # follow along; the file only becomes raw.jsonl once decoding is complete.
+    part_file = output_file + ".part"
+    with CueWriter(part_file) as writer:
+        for segment in segments:
+            text = segment.text.strip().replace(" ", "").replace("　", "")
+            text = fold_repetitions(text)
+
+            if len(text) < 1: continue
+            if is_prompt_mirror(text, initial_prompt): continue
+            if is_hallucination(text, segment.compression_ratio): continue
+            if segment.avg_logprob < -1.0 and len(text) < 5: continue
+
+            print(f"Processing: {format_srt_time(to_ms(segment.start))} -> {format_srt_time(to_ms(segment.end))}", flush=True)
+
+            for cue in split_by_sentence_end(segment):
+                writer.write(cue)
 
+    replace_file(part_file, output_file)
+    ctx.stages.record("transcribe", output_file, inputs)
+
+    wall = time.perf_counter() - started
+    audio_seconds = os.path.getsize(audio_path) / 2 / SAMPLE_RATE
+    telemetry.emit("transcription", ctx, audio_s=round(audio_seconds, 1), wall_s=round(wall, 3),
+                   cpu_s=round(time.process_time() - cpu_started, 3), rtf=round(wall / audio_seconds, 4) if audio_seconds else None,
+                   entries=writer.count, chunk_workers=chunk_workers, profile=profile_name)
+
+def serve():
+    """Worker mode: load the model once and transcribe one input path per stdin line.
+
+    Each job ends with a `JOB_DONE: ok <path>` or `JOB_DONE: failed <path>` line.
+    """
+    shared = {}
+    for line in sys.stdin:
+        input_file = line.strip()
+        if not input_file: continue
+        ok = True
+        try:
+            ctx = JobContext(input_file, shared)
+            job = check_job(ctx)
+            if job:
+                with telemetry.profile("_1_whisper.py", ctx):
+                    transcribe_file(ctx, *job)
+        except Exception as e:
+            print(f"ERROR: Transcription failed: {e}", flush=True)
+            ok = False
+        print(f"JOB_DONE: {'ok' if ok else 'failed'} {input_file}", flush=True)
     os._exit(0)
 
+def main(ctx=None):
+    """Transcribe one file. Without a context the input path is read from argv."""
+    in_process = ctx is not None
+    if not in_process:
+        if len(sys.argv) < 2: sys.exit(1)
+        if sys.argv[1] == "--worker":
+            serve()
+        ctx = JobContext(sys.argv[1])
+
+    try:
+        job = check_job(ctx)
+    except FileNotFoundError as e:
+        print(f"ERROR: {e}", flush=True)
+        sys.exit(1)
+    if not job:
+        if in_process: return
+        sys.exit(0)
+
+    transcribe_file(ctx, *job)
+
+    if not in_process:
+        os._exit(0)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
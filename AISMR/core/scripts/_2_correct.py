@@ -2,45 +2,18 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import json
-import re
-import glob
-import pykakasi
+from collections import deque
+from functools import lru_cache
 from difflib import SequenceMatcher
-from utils import get_cache_dir, load_asmr_dict, load_temp_dict, PROMPTS_DIR
-
-def get_acoustic_fingerprint(text):
-    if not text: return ""
-    s = text.lower()
-    s = re.sub(r'[^a-z]', '', s)
-    trans_table = str.maketrans({
-        'b': 'h', 'p': 'h',
-        'd': 't',
-        'g': 'k',
-        'z': 's', 'j': 's'
-    })
-    s = s.translate(trans_table)
-    s = re.sub(r'([a-z])\1+', r'\1', s)
-    return s
-
-def load_correction_data(input_file):
-    """Load both global and temporary dictionaries"""
-    # Load global dictionary
-    global_data = load_asmr_dict()
-
-    # Get prompt file name
-    prompt_file_name = "default.txt"
-    if os.path.exists(PROMPTS_DIR):
-        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
-        if txt_files:
-            prompt_file_name = os.path.basename(txt_files[0])
-    elif os.path.exists("ReadMe.txt"):
-        prompt_file_name = "ReadMe.txt"
-
-    # Load temporary dictionary for this file
-    temp_data = load_temp_dict(prompt_file_name)
+from utils import JobContext, replace_file
+from stage_cache import digest
+from correction_engine import CorrectionEngine, get_acoustic_fingerprint
+from subtitles import CueWriter, read_cues, write_cues
 
-    # Merge both dictionaries
-    all_data = global_data + temp_data
+def load_correction_data(ctx):
+    """Load both global and temporary dictionaries"""
+    # Merge global dictionary and temporary dictionary for this prompt file
+    all_data = ctx.asmr_dict + ctx.temp_dict
 
     replace_map = {}
     phonetic_map = {}
@@ -61,41 +34,8 @@ def load_correction_data(input_file):
                 phonetic_map[fp] = term
     return replace_map, phonetic_map, noise_keywords
 
-def parse_srt(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f: content = f.read()
-    entries = []
-    for block in content.strip().split('\n\n'):
-        lines = block.split('\n')
-        if len(lines) >= 3:
-            entries.append({'index': int(lines[0]), 'timestamp': lines[1], 'text': " ".join(lines[2:])})
-    return entries
-
-def save_srt(file_path, entries):
-    with open(file_path, 'w', encoding='utf-8') as f:
-        for i, e in enumerate(entries):
-            f.write(f"{i+1}\n{e['timestamp']}\n{e['text']}\n\n")
-
-def batch_replace(text, replace_map):
-    if not replace_map: return text
-    sorted_keys = sorted(replace_map.keys(), key=len, reverse=True)
-    pattern = re.compile("|".join(map(re.escape, sorted_keys)))
-    return pattern.sub(lambda m: replace_map[m.group(0)], text)
-
-def phonetic_replace(text, phonetic_map, kks_converter):
-    if not text.strip(): return text
-    result = []
-    tokens = kks_converter.convert(text)
-    for token in tokens:
-        hepburn = token['hepburn']
-        fp = get_acoustic_fingerprint(hepburn)
-        if fp in phonetic_map:
-            result.append(phonetic_map[fp])
-        else:
-            result.append(token['orig'])
-    return "".join(result)
-
-def compress_repetitions(text):
-    return re.sub(r'([ー〜～…\.!? ])\1{2,}', r'\1\1', text)
+def correction_inputs(ctx):
+    return {'raw': ctx.stages.output_id("transcribe"), 'dictionary': digest(ctx.asmr_dict + ctx.temp_dict)}
 
 def is_noise_line(text, noise_keywords):
     if len(text) > 20: return False
@@ -103,73 +43,109 @@ def is_noise_line(text, noise_keywords):
         if kw in text: return True
     return False
 
+SIMILARITY_THRESHOLD = 0.6
+
+@lru_cache(maxsize=4096)
 def are_similar(t1, t2):
-    return SequenceMatcher(None, t1, t2).ratio() > 0.6
+    """SequenceMatcher ratio above the threshold, rejecting by the cheap upper bounds first.
+
+    ratio() <= quick_ratio() <= real_quick_ratio(), so the prefilters never
+    change the answer; most pairs are decided by length alone.
+    """
+    total = len(t1) + len(t2)
+    if not total:
+        return True  # SequenceMatcher rates two empty strings 1.0
+    if 2 * min(len(t1), len(t2)) / total <= SIMILARITY_THRESHOLD:
+        return False
+    matcher = SequenceMatcher(None, t1, t2)
+    return matcher.quick_ratio() > SIMILARITY_THRESHOLD and matcher.ratio() > SIMILARITY_THRESHOLD
+
+def fold_entries(entries, noise_keywords):
+    """Drop runs of identical lines and collapse similar noise streaks.
+
+    Works on any iterable, reading ahead only as far as a run or streak goes,
+    so it can sit behind a transcription that is still in progress.
+    """
+    it = iter(entries)
+    buf = deque()
+
+    def fill(k):
+        while len(buf) < k:
+            try:
+                buf.append(next(it))
+            except StopIteration:
+                return False
+        return True
+
+    while fill(1):
+        curr = buf[0]
+        curr_text = curr.text
+        if fill(4) and buf[1].text == curr_text and buf[2].text == curr_text and buf[3].text == curr_text:
+            while fill(1) and buf[0].text == curr_text:
+                buf.popleft()
+            continue
+        if is_noise_line(curr_text, noise_keywords):
+            streak = 1
+            while fill(streak + 1) and is_noise_line(buf[streak].text, noise_keywords) and are_similar(buf[streak].text, curr_text):
+                streak += 1
+            yield curr
+            for _ in range(streak if streak >= 3 else 1):
+                buf.popleft()
+        else:
+            yield buf.popleft()
+
+def correct_entries(entries, ctx):
+    """Lazily correct an iterable of raw cues"""
+    replace_map, phonetic_map, noise_keywords = ctx.cached("correction_data", lambda: load_correction_data(ctx))
+    engine = ctx.cached("correction_engine", lambda: CorrectionEngine(replace_map, phonetic_map, ctx.readings))
+
+    def corrected():
+        for cue in entries:
+            cue.text = engine.correct(cue.text)
+            yield cue
+        ctx.readings.flush()
 
-def process_correction(input_file):
+    return fold_entries(corrected(), noise_keywords)
+
+def stream_correction(ctx, entries):
+    """Correct cues as they arrive, writing corrected.jsonl once the input is exhausted"""
+    print("STATUS: Correcting Text", flush=True)
+    part_file = ctx.corrected_path + ".part"
+    with CueWriter(part_file) as writer:
+        for cue in correct_entries(entries, ctx):
+            writer.write(cue)
+            yield cue
+    replace_file(part_file, ctx.corrected_path)
+    # raw.jsonl is only recorded once transcription has finished, i.e. now
+    ctx.stages.record("correct", ctx.corrected_path, correction_inputs(ctx))
+
+def process_correction(input_file, ctx=None):
     print("STATUS: Loading Correction Data", flush=True)
 
     if not os.path.exists(input_file):
         print(f"ERROR: Input file not found: {input_file}", flush=True)
         sys.exit(1)
 
-    cache_dir = get_cache_dir(input_file)
-    raw_srt = os.path.join(cache_dir, "raw.srt")
-    corrected_srt = os.path.join(cache_dir, "corrected.srt")
+    if ctx is None:
+        ctx = JobContext(input_file)
+    raw_path = ctx.raw_path
+    corrected_path = ctx.corrected_path
 
-    if os.path.exists(corrected_srt) and os.path.getsize(corrected_srt) > 0:
+    inputs = correction_inputs(ctx)
+    if ctx.stages.is_fresh("correct", corrected_path, inputs):
         return
 
-    if not os.path.exists(raw_srt):
-        print(f"ERROR: Raw SRT not found: {raw_srt}", flush=True)
+    if not os.path.exists(raw_path):
+        print(f"ERROR: Raw transcript not found: {raw_path}", flush=True)
         sys.exit(1)
 
-    replace_map, phonetic_map, noise_keywords = load_correction_data(input_file)
-    entries = parse_srt(raw_srt)
-    kks = pykakasi.kakasi()
+    entries = read_cues(raw_path)
 
     print("STATUS: Correcting Text", flush=True)
-    processed_entries = []
-    for entry in entries:
-        t = entry['text']
-        t = batch_replace(t, replace_map)
-        t = phonetic_replace(t, phonetic_map, kks)
-        t = compress_repetitions(t)
-        entry['text'] = t
-        processed_entries.append(entry)
-    
-    final_entries = []
-    i = 0
-    n = len(processed_entries)
-    while i < n:
-        curr = processed_entries[i]
-        curr_text = curr['text']
-        if i + 3 < n:
-            if (processed_entries[i+1]['text'] == curr_text and 
-                processed_entries[i+2]['text'] == curr_text and 
-                processed_entries[i+3]['text'] == curr_text):
-                j = i + 1
-                while j < n and processed_entries[j]['text'] == curr_text:
-                    j += 1
-                i = j
-                continue
-        if is_noise_line(curr_text, noise_keywords):
-            j = i + 1
-            streak = 1
-            while j < n and is_noise_line(processed_entries[j]['text'], noise_keywords) and are_similar(processed_entries[j]['text'], curr_text):
-                streak += 1
-                j += 1
-            if streak >= 3:
-                final_entries.append(curr)
-                i = j
-            else:
-                final_entries.append(curr)
-                i += 1
-        else:
-            final_entries.append(curr)
-            i += 1
-            
-    save_srt(corrected_srt, final_entries)
+    final_entries = list(correct_entries(entries, ctx))
+
+    write_cues(corrected_path, final_entries)
+    ctx.stages.record("correct", corrected_path, inputs)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2: sys.exit(1)
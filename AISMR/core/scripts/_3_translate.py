@@ -2,133 +2,327 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import json
-import glob
-from utils import LocalLLM, get_cache_dir, load_asmr_dict, get_assets_context_path, PROMPTS_DIR
+import threading
+import requests
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from utils import JobContext, get_assets_context_path, get_sakura_model
+from translation_memory import LOOKUP_CHUNK, TranslationMemory, context_fingerprint, normalize_source
+from stage_cache import digest
+from subtitles import Cue, CueWriter, read_track
+import telemetry
 
 BATCH_SIZE = 10
+MIN_BATCH_SIZE = 2
+MAX_BATCH_SIZE = 20
 MAX_HISTORY = 5
+# Source tokens per batch; keeps the reply well inside n_predict=1024
+TOKEN_BUDGET = int(os.environ.get("TRANSLATE_TOKEN_BUDGET", 400))
 
-def parse_srt(file_path):
-    with open(file_path, 'r', encoding='utf-8') as f: content = f.read()
-    entries = []
-    for block in content.strip().split('\n\n'):
-        lines = block.split('\n')
-        if len(lines) >= 3:
-            entries.append({'index': lines[0], 'timestamp': lines[1], 'text': " ".join(lines[2:])})
-    return entries
-
-def save_srt_append(file_path, entries):
-    with open(file_path, 'a' if os.path.exists(file_path) else 'w', encoding='utf-8') as f:
-        for e in entries: f.write(f"{e['index']}\n{e['timestamp']}\n{e['text']}\n\n")
-
-def load_filtered_glossary(full_text):
+def load_filtered_glossary(full_text, dict_data):
     relevant_glossary = []
     try:
-        common_data = load_asmr_dict()
-        for item in common_data:
+        for item in dict_data:
             term = item.get('term')
             translation = item.get('trans')
             if term and translation and item.get("type") != "noise":
-                if term in full_text:
+                if full_text is None or term in full_text:
                     relevant_glossary.append(f"{term}->{translation}")
-    except: pass
+    except (AttributeError, TypeError):
+        pass
     return "\n".join(relevant_glossary)
 
-def load_context_info(input_file):
+def load_context_info(ctx):
     summary = ""
     style = ""
 
-    prompt_file_name = "default.txt"
-    if os.path.exists(PROMPTS_DIR):
-        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
-        if txt_files:
-            prompt_file_name = os.path.basename(txt_files[0])
-    elif os.path.exists("ReadMe.txt"):
-        prompt_file_name = "ReadMe.txt"
-
-    context_file = get_assets_context_path(prompt_file_name)
+    context_file = get_assets_context_path(ctx.prompt_file_name)
     if os.path.exists(context_file):
         try:
             with open(context_file, "r", encoding="utf-8") as f:
                 d = json.load(f)
                 summary = d.get("summary", "")
                 style = d.get("style", "")
-        except:
+        except (OSError, ValueError, AttributeError):
             pass
 
     return summary, style
 
-def recursive_translate(llm, items, history, context_tuple):
+def translation_inputs(ctx):
+    model = get_sakura_model()
+    model_size = os.path.getsize(model) if os.path.exists(model) else 0
+    return {
+        'corrected': ctx.stages.output_id("correct"),
+        'model': digest([os.path.basename(model), model_size]),
+        'context': digest(load_context_info(ctx)),
+        'dictionary': digest(ctx.asmr_dict),
+    }
+
+def build_prompt_prefix(context_tuple):
+    """Static head of every translation prompt: instructions, summary, style and glossary.
+
+    It is identical for all requests of a file so llama-server can reuse its
+    KV cache; only the history and the text to translate follow it.
+    """
     summary, style, glossary = context_tuple
-    
+
     sys_prompt = "你是一个视觉小说翻译模型，可以通顺地使用给定的术语表以指定的风格将日文翻译成简体中文。"
     if summary: sys_prompt += f"\n剧情背景：{summary}"
     if style: sys_prompt += f"\n翻译风格要求：{style}"
-    if history:
-        recent_context = history[-3:] 
-        sys_prompt += f"\n上文回顾：{' | '.join(recent_context)}"
 
-    user_prompt_parts = []
+    prefix = f"<|im_start|>system\n{sys_prompt}<|im_end|>\n<|im_start|>user\n"
     if glossary:
-        user_prompt_parts.append(f"参考以下术语表：\n{glossary}\n")
-    
+        prefix += f"参考以下术语表：\n{glossary}\n\n"
+    return prefix
+
+def report_prompt_cache(result):
+    cached = result.get('tokens_cached')
+    evaluated = result.get('tokens_evaluated')
+    if cached is not None and evaluated:
+        print(f"Prompt cache: reused {cached}/{evaluated} prompt tokens", flush=True)
+
+class AdaptiveBatcher:
+    """Packs lines into batches under a token budget measured by the server.
+
+    The line cap per batch shrinks when recent multi-line requests come back
+    with the wrong number of lines and grows again when they stop doing so.
+    Tokens of replies thrown away for bisection are counted in `wasted_*`.
+    """
+
+    def __init__(self, llm, token_budget=TOKEN_BUDGET, max_lines=BATCH_SIZE):
+        self.llm = llm
+        self.token_budget = token_budget
+        self.max_lines = max_lines
+        self.recent = deque(maxlen=20)
+        self.requests = 0
+        self.mismatches = 0
+        self.wasted_prompt_tokens = 0
+        self.wasted_generated_tokens = 0
+        self.lock = threading.Lock()
+
+    def batches(self, items):
+        batch = []
+        tokens = 0
+        for item in items:
+            n = self.llm.count_tokens(item['text'])
+            if batch and (len(batch) >= self.max_lines or tokens + n > self.token_budget):
+                yield batch
+                batch = []
+                tokens = 0
+            batch.append(item)
+            tokens += n
+        if batch:
+            yield batch
+
+    def record(self, mismatch, result=None):
+        with self.lock:
+            self.requests += 1
+            self.recent.append(1 if mismatch else 0)
+            if mismatch:
+                self.mismatches += 1
+                if result:
+                    self.wasted_prompt_tokens += result.get('timings', {}).get('prompt_n', 0)
+                    self.wasted_generated_tokens += result.get('tokens_predicted', 0)
+            if len(self.recent) < 5:
+                return
+            rate = sum(self.recent) / len(self.recent)
+            if rate > 0.3 and self.max_lines > MIN_BATCH_SIZE:
+                self.max_lines = max(MIN_BATCH_SIZE, self.max_lines - 2)
+                self.recent.clear()
+            elif rate < 0.1 and self.max_lines < MAX_BATCH_SIZE:
+                self.max_lines += 1
+                self.recent.clear()
+
+    def summary(self):
+        return (f"Bisection: {self.mismatches}/{self.requests} batches mismatched, "
+                f"discarded {self.wasted_prompt_tokens} prompt + {self.wasted_generated_tokens} generated tokens "
+                f"(final batch cap {self.max_lines} lines)")
+
+def recursive_translate(llm, items, history, context_tuple, batcher=None):
+    user_prompt_parts = []
+    if history:
+        recent_context = history[-3:]
+        user_prompt_parts.append(f"上文回顾：{' | '.join(recent_context)}\n")
+
     current_text = "\n".join([i['text'] for i in items])
     user_prompt_parts.append(f"将下面的文本从日文翻译成简体中文：\n{current_text}")
     
     user_prompt = "\n".join(user_prompt_parts)
     
-    prompt = f"<|im_start|>system\n{sys_prompt}<|im_end|>\n<|im_start|>user\n{user_prompt}<|im_end|>\n<|im_start|>assistant\n"
+    prompt = f"{build_prompt_prefix(context_tuple)}{user_prompt}<|im_end|>\n<|im_start|>assistant\n"
     
+    result = None
     try:
-        res = llm.completion(prompt, temperature=0.3, top_p=0.8).replace("<|im_end|>", "").strip()
-        lines = [l.strip() for l in res.split('\n') if l.strip()]
-        if len(lines) == len(items): return lines
-        if len(items) == 1 and len(lines) > 0: return [lines[0]]
-    except: pass
-    
+        result = llm.completion_result(prompt, temperature=0.3, top_p=0.8)
+        res = result['content'].replace("<|im_end|>", "").strip()
+    except (requests.JSONDecodeError, KeyError, TypeError, AttributeError):
+        # A garbled reply is split like a mismatch; timeouts and connection errors fail the stage
+        res = ""
+    else:
+        report_prompt_cache(result)
+    lines = [l.strip() for l in res.split('\n') if l.strip()]
+    if len(lines) == len(items):
+        if batcher and len(items) > 1: batcher.record(False)
+        return lines
+    if len(items) == 1 and len(lines) > 0: return [lines[0]]
+
     if len(items) > 1:
+        if batcher: batcher.record(True, result)
         mid = len(items) // 2
-        res_first = recursive_translate(llm, items[:mid], history, context_tuple)
-        res_second = recursive_translate(llm, items[mid:], history + res_first, context_tuple)
+        res_first = recursive_translate(llm, items[:mid], history, context_tuple, batcher)
+        res_second = recursive_translate(llm, items[mid:], history + res_first, context_tuple, batcher)
         return res_first + res_second
     return [items[0]['text']]
 
-def main():
-    if len(sys.argv) < 2: sys.exit(1)
-    print("STATUS: Loading Translation Data", flush=True)
+def translate_batches(llm, batches, context_tuple, parallel=1, batcher=None):
+    """Yield (batch, translated lines) for each batch, in batch order.
 
-    input_file = sys.argv[1]
-    cache_dir = get_cache_dir(input_file)
-    inp_srt = os.path.join(cache_dir, "corrected.srt")
-    trans_srt = os.path.join(cache_dir, "translated.srt")
+    With `parallel` > 1 up to that many batches are in flight at once on the
+    server's slots. Their history cannot wait for the previous translation, so
+    it is seeded from the source text of the lines just before the batch.
+    """
+    if parallel <= 1:
+        history = []
+        for batch in batches:
+            results = recursive_translate(llm, batch, history, context_tuple, batcher)
+            history = (history + results)[-MAX_HISTORY:]
+            yield batch, results
+        return
 
-    if os.path.exists(trans_srt) and os.path.getsize(trans_srt) > 0:
-        sys.exit(0)
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        pending = deque()
+        source_history = []
+        for batch in batches:
+            pending.append((batch, pool.submit(recursive_translate, llm, batch, source_history, context_tuple, batcher)))
+            source_history = (source_history + [b['text'] for b in batch])[-MAX_HISTORY:]
+            if len(pending) >= parallel:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
 
-    if not os.path.exists(inp_srt):
-        sys.exit(1)
+def translate_entries(ctx, entries, glossary_str):
+    """Translate an iterable of cues into translated.jsonl, in order.
 
-    entries = parse_srt(inp_srt)
+    `entries` may still be growing (streaming mode): lines are looked up in the
+    translation memory as they arrive and the misses are batched for the LLM.
+    Sakura is held from the server pool until the last line is written.
+    """
+    parallel = max(1, int(os.environ.get("LLM_PARALLEL", 1)))
+    with ctx.llm(get_sakura_model(), parallel) as llm:
+        translate_with(ctx, llm, entries, glossary_str, parallel)
 
-    full_text = "".join([e['text'] for e in entries])
-    glossary_str = load_filtered_glossary(full_text)
-    summary, style = load_context_info(input_file)
+def translate_with(ctx, llm, entries, glossary_str, parallel):
+    summary, style = load_context_info(ctx)
     context_tuple = (summary, style, glossary_str)
 
-    llm = LocalLLM(port=int(os.environ.get("LLM_PORT", 8080)))
+    memory = TranslationMemory(context_fingerprint(os.path.basename(get_sakura_model()), summary, style, ctx.asmr_dict))
+    batcher = AdaptiveBatcher(llm)
+    ordered = []
+    keys = []
+    known = {}
+    queued = set()
+    translated_lines = 0
+    written = 0
+    repeats = 0
+
+    def misses():
+        # Only the first occurrence of each line missing from memory goes to the LLM.
+        # A whole track is looked up LOOKUP_CHUNK lines per query, a stream line by
+        # line so that no cue waits for later ones
+        nonlocal repeats
+        source = iter(entries)
+        chunk_size = LOOKUP_CHUNK if hasattr(entries, '__len__') else 1
+        while True:
+            chunk = list(islice(source, chunk_size))
+            if not chunk:
+                return
+            chunk_keys = [normalize_source(e.text) for e in chunk]
+            unknown = {key for key in chunk_keys if key not in known and key not in queued}
+            if unknown:
+                known.update(memory.lookup(unknown))
+            for e, key in zip(chunk, chunk_keys):
+                ordered.append(e)
+                keys.append(key)
+                if key in queued:
+                    # Repeated within this file, served by its first translation
+                    repeats += 1
+                    continue
+                if key in known:
+                    memory.hits += 1
+                    continue
+                memory.misses += 1
+                queued.add(key)
+                yield {'text': e.text, 'key': key}
 
-    history = []
-    total_batches = (len(entries) + BATCH_SIZE - 1) // BATCH_SIZE
+    def flush_ready():
+        nonlocal written
+        while written < len(ordered) and keys[written] in known:
+            e = ordered[written]
+            writer.write(Cue(e.start, e.end, known[keys[written]]))
+            written += 1
 
     print("STATUS: Translating Text", flush=True)
-    for i in range(0, len(entries), BATCH_SIZE):
-        batch = entries[i:i+BATCH_SIZE]
-        current_batch_num = i // BATCH_SIZE + 1
-        print(f"Translating batch {current_batch_num}/{total_batches}...", flush=True)
-
-        results = recursive_translate(llm, batch, history, context_tuple)
-        save_srt_append(trans_srt, [{'index': b['index'], 'timestamp': b['timestamp'], 'text': r} for b, r in zip(batch, results)])
-        history = (history + results)[-MAX_HISTORY:]
+    writer = CueWriter(ctx.translated_path)
+    try:
+        batches = batcher.batches(misses())
+        for current_batch_num, (batch, results) in enumerate(translate_batches(llm, batches, context_tuple, parallel, batcher), 1):
+            translated_lines += len(batch)
+            print(f"Translating batch {current_batch_num} ({translated_lines}/{len(queued)} lines)...", flush=True)
+            for b, r in zip(batch, results):
+                known[b['key']] = r
+            # A line that came back untranslated is not worth remembering
+            memory.store([(b['key'], r) for b, r in zip(batch, results) if r != b['text']])
+            flush_ready()
+        flush_ready()
+    finally:
+        writer.close()
+        memory.close()
+    print(f"Translation memory: {memory.hits} hits, {memory.misses} misses, {repeats} repeated lines, "
+          f"{len(queued)} unique lines translated", flush=True)
+    print(batcher.summary(), flush=True)
+    telemetry.llm_usage(ctx, "_3_translate.py", llm)
+    telemetry.emit("translation", ctx, lines=len(ordered), unique_translated=len(queued),
+                   memory_hits=memory.hits, memory_misses=memory.misses, repeated_lines=repeats,
+                   mismatched_batches=batcher.mismatches)
+
+def translate_stream(ctx, entries):
+    """Translate corrected entries while they are still being produced.
+
+    The full text is not known yet, so the glossary is not filtered by it.
+    """
+    print("STATUS: Loading Translation Data", flush=True)
+    if os.path.exists(ctx.translated_path):
+        os.remove(ctx.translated_path)
+    translate_entries(ctx, entries, load_filtered_glossary(None, ctx.asmr_dict))
+    ctx.stages.record("translate", ctx.translated_path, translation_inputs(ctx))
+
+def main(ctx=None):
+    if ctx is None:
+        if len(sys.argv) < 2: sys.exit(1)
+        ctx = JobContext(sys.argv[1])
+    print("STATUS: Loading Translation Data", flush=True)
+
+    corrected_path = ctx.corrected_path
+    translated_path = ctx.translated_path
+
+    inputs = translation_inputs(ctx)
+    if ctx.stages.is_fresh("translate", translated_path, inputs):
+        return
+
+    if not os.path.exists(corrected_path):
+        sys.exit(1)
+    # Translations are appended as they finish; drop an outdated or partial file
+    if os.path.exists(translated_path):
+        os.remove(translated_path)
+
+    track = read_track(corrected_path)
+
+    glossary_str = load_filtered_glossary("".join(track.texts), ctx.asmr_dict)
+    translate_entries(ctx, track, glossary_str)
+    ctx.stages.record("translate", translated_path, inputs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
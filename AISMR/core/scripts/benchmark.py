@@ -0,0 +1,735 @@
+"""Performance checks for pipeline stages.
+
+    python benchmark.py normalize <media> [--runs N] [--tolerance LU]
+    python benchmark.py correct [--lines N ...] [--terms N ...]
+    python benchmark.py kernels [--sizes N ...]
+    python benchmark.py suite [--hours H] [--terms N] [--save-baseline] [--threshold F]
+    python benchmark.py pool [--rounds N] [--stub SECONDS]
+    python benchmark.py translate [--lines N] [--parallel N] [--latency SECONDS]
+    python benchmark.py download [--size-mb N] [--segments N]
+
+normalize: times each normalization engine on the same source and checks that
+the outputs have equivalent integrated loudness (within --tolerance LU).
+correct: times dictionary correction on synthetic transcripts and dictionaries
+of growing size; time per line should stay flat as either one grows.
+kernels: worst-case inputs for repetition folding and noise-streak similarity,
+checked against the regex / SequenceMatcher results they replace.
+suite: every CPU-bound text step on a synthetic transcript of --hours of audio,
+compared per cue against a stored baseline (benchmark_baseline.json next to
+this script, machine specific and not versioned). Exits 1 when a step got
+slower than the baseline by more than --threshold.
+pool: alternating Qwen / Sakura requests through the server pool, once with
+one model resident at a time and once with a budget that fits both, then
+with one kept alive for a second run; prints server starts, reuses and time.
+Its servers keep their state in a temporary directory, apart from those of a
+real run. --stub replaces llama-server and the models with a stand-in that
+takes SECONDS to load.
+translate: translation batches on one and on --parallel slots of a stand-in
+server that takes --latency per request; prints the speedup of the slots.
+download: the model downloader against a local stand-in for Hugging Face
+(redirect, Range, X-Linked-ETag) that drops connections, with one and with
+--segments parallel ranges.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+if current_dir not in sys.path:
+    sys.path.insert(0, current_dir)
+
+import _0_prepare
+import _1_whisper
+import _2_correct
+import _3_translate
+import _4_output
+import downloader
+import loudness
+from correction_engine import CorrectionEngine, get_acoustic_fingerprint
+from reading_cache import ReadingCache
+from text_kernels import fold_line, fold_repetitions
+from subtitles import Cue, read_cues, write_cues
+from server_pool import ServerPool, estimate_bytes
+from utils import JobContext, LocalLLM, get_qwen_model, get_sakura_model
+
+def ffmpeg_loudness(pcm_path):
+    """Integrated loudness of raw 16 kHz s16le PCM according to ffmpeg's ebur128 filter"""
+    cmd = ["ffmpeg", "-nostdin", "-hide_banner", "-f", "s16le", "-ar", "16000", "-ac", "1",
+           "-i", pcm_path, "-af", "ebur128", "-f", "null", "-"]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+    except OSError:
+        return None
+    found = re.findall(r"I:\s+(-?[\d.]+) LUFS", result.stderr)
+    return float(found[-1]) if found else None
+
+def bench_normalize(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for engine in _0_prepare.NORMALIZE_ENGINES:
+            out = os.path.join(tmp, f"{engine}.pcm")
+            times = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                _0_prepare.run_ffmpeg_normalization(args.media, out, engine)
+                times.append(time.perf_counter() - start)
+            audio_seconds = os.path.getsize(out) / 2 / loudness.SAMPLE_RATE
+            results[engine] = dict(
+                time=min(times),
+                rtf=min(times) / audio_seconds if audio_seconds else 0.0,
+                lufs=loudness.measure_pcm(out),
+                ebur128=ffmpeg_loudness(out),
+            )
+
+    print(f"{'engine':<10} {'best s':>8} {'RTF':>8} {'LUFS':>8} {'ebur128':>8}")
+    for engine, r in results.items():
+        fmt = lambda v: "-" if v is None else f"{v:.2f}"
+        print(f"{engine:<10} {r['time']:>8.2f} {r['rtf']:>8.4f} {fmt(r['lufs']):>8} {fmt(r['ebur128']):>8}")
+
+    base, fast = results["loudnorm"], results["fast"]
+    if base["time"]:
+        print(f"Speedup: {base['time'] / fast['time']:.2f}x")
+
+    key = "ebur128" if base["ebur128"] is not None and fast["ebur128"] is not None else "lufs"
+    if base[key] is None or fast[key] is None:
+        print("Loudness check skipped: silent output")
+        return 0
+    delta = fast[key] - base[key]
+    ok = abs(delta) <= args.tolerance
+    print(f"Loudness difference ({key}): {delta:+.2f} LU -> {'OK' if ok else 'FAIL'} (tolerance {args.tolerance} LU)")
+    return 0 if ok else 1
+
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+KANJI = "魔女像写真簿記先輩耳元声音夢中毎日本当気持"
+SYLLABLES = ["ka", "ki", "ku", "ke", "ko", "sa", "shi", "su", "ta", "chi", "na", "ni", "ma", "mi", "ra", "ri", "zo", "bo", "pa"]
+
+def synthetic_dictionary(n_terms, rng):
+    """Terms with 1-3 literal wrongs and a reading each, like asmr_dictionary.json"""
+    entries = []
+    for i in range(n_terms):
+        entries.append({
+            "term": f"T{i}",
+            "reading": "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))),
+            "wrongs": ["".join(rng.choice(KANJI) for _ in range(rng.randint(2, 3))) for _ in range(rng.randint(1, 3))],
+        })
+    return entries
+
+def synthetic_lines(n_lines, rng, dictionary):
+    lines = []
+    wrongs = [w for e in dictionary for w in e.get("wrongs", [])]
+    for _ in range(n_lines):
+        parts = [rng.choice(KANA + KANJI) for _ in range(rng.randint(8, 24))]
+        if wrongs and rng.random() < 0.3:
+            parts.insert(rng.randrange(len(parts)), rng.choice(wrongs))
+        lines.append("".join(parts))
+    return lines
+
+def regex_replace(text, replace_map):
+    """The previous per-line approach: sort and compile the alternation for every line"""
+    if not replace_map: return text
+    sorted_keys = sorted(replace_map.keys(), key=len, reverse=True)
+    pattern = re.compile("|".join(map(re.escape, sorted_keys)))
+    return pattern.sub(lambda m: replace_map[m.group(0)], text)
+
+def bench_correct(args):
+    rng = random.Random(0)
+    tmp = tempfile.mkdtemp()
+    print(f"{'terms':>6} {'lines':>6} {'build ms':>9} {'literal us/line':>16} {'full us/line':>13} {'memo us/line':>13} {'regex us/line':>14}")
+    worst = 0.0
+    for n_terms in args.terms:
+        dictionary = synthetic_dictionary(n_terms, rng)
+        replace_map = {w: e["term"] for e in dictionary for w in e["wrongs"]}
+        phonetic_map = {}
+        for e in dictionary:
+            phonetic_map.setdefault(get_acoustic_fingerprint(e["reading"]), e["term"])
+
+        start = time.perf_counter()
+        readings = ReadingCache(os.path.join(tmp, f"readings_{n_terms}.db"))
+        engine = CorrectionEngine(replace_map, phonetic_map, readings)
+        readings.tokens("")  # loads the pykakasi dictionaries
+        build = time.perf_counter() - start
+
+        per_line = []
+        for n_lines in args.lines:
+            lines = synthetic_lines(n_lines, rng, dictionary)
+            start = time.perf_counter()
+            literal = [engine.literal_replace(t) for t in lines]
+            t_literal = time.perf_counter() - start
+            start = time.perf_counter()
+            for t in lines:
+                engine.correct(t)
+            t_full = time.perf_counter() - start
+            # Second pass over the same lines: every reading comes from the memo
+            start = time.perf_counter()
+            for t in lines:
+                engine.correct(t)
+            t_memo = time.perf_counter() - start
+            sample = lines[:min(len(lines), 500)]
+            start = time.perf_counter()
+            reference = [regex_replace(t, replace_map) for t in sample]
+            t_regex = (time.perf_counter() - start) / len(sample) * len(lines)
+            if reference != literal[:len(sample)]:
+                print("ERROR: literal replacement differs from the regex reference")
+                return 1
+            per_line.append(t_full / n_lines)
+            print(f"{n_terms:>6} {n_lines:>6} {build * 1e3:>9.1f} {t_literal / n_lines * 1e6:>16.1f} "
+                  f"{t_full / n_lines * 1e6:>13.1f} {t_memo / n_lines * 1e6:>13.1f} {t_regex / n_lines * 1e6:>14.1f}")
+        readings.close()
+        worst = max(worst, max(per_line) / min(per_line))
+    shutil.rmtree(tmp, ignore_errors=True)
+    print(f"Per-line time spread across transcript sizes: {worst:.2f}x (1.0 = linear)")
+    return 0
+
+def adversarial_texts(n, rng):
+    """Inputs that make the backtracking regex try every start and every length"""
+    return {
+        # no 3-fold repeat anywhere: every (start, length) pair fails
+        "random": "".join(rng.choice("あいうえおかきくけこ") for _ in range(n)),
+        # units that repeat twice and then break, like a loop Whisper almost fell into
+        "near-loop": "".join("ああっ" * 2 + rng.choice("んー") for _ in range(n // 7)),
+        "breathing": "".join(rng.choice(["はぁ", "はぁっ", "ん"]) for _ in range(n // 2)),
+        # a real hallucinated loop
+        "loop": "はぁ" * (n // 2),
+    }
+
+def bench_kernels(args):
+    rng = random.Random(0)
+    regex = re.compile(r'(.+?)\1{2,}')
+    print(f"{'input':<10} {'chars':>6} {'regex s':>9} {'kernel s':>9}")
+    for n in args.sizes:
+        for name, text in adversarial_texts(n, rng).items():
+            start = time.perf_counter()
+            expected = regex.sub(r'\1...', text)
+            t_regex = time.perf_counter() - start
+            start = time.perf_counter()
+            result = fold_repetitions(text)
+            t_kernel = time.perf_counter() - start
+            # Short lines take the regex in fold_repetitions; check the kernel on its own too
+            if result != expected or fold_line(text) != expected:
+                print(f"ERROR: fold_repetitions differs from the regex on {name} ({n} chars)")
+                return 1
+            print(f"{name:<10} {n:>6} {t_regex:>9.4f} {t_kernel:>9.4f}")
+
+    from difflib import SequenceMatcher
+    from _2_correct import are_similar
+    noise = ["".join(rng.choice("あっんはぁ…") for _ in range(rng.randint(1, 20))) for _ in range(20000)]
+    pairs = list(zip(noise, noise[1:]))
+    start = time.perf_counter()
+    expected = [SequenceMatcher(None, a, b).ratio() > 0.6 for a, b in pairs]
+    t_plain = time.perf_counter() - start
+    are_similar.cache_clear()
+    start = time.perf_counter()
+    result = [are_similar(a, b) for a, b in pairs]
+    t_new = time.perf_counter() - start
+    if result != expected:
+        print("ERROR: are_similar differs from SequenceMatcher.ratio()")
+        return 1
+    print(f"noise similarity, {len(pairs)} pairs: SequenceMatcher {t_plain:.3f}s, prefiltered {t_new:.3f}s")
+    return 0
+
+BASELINE_PATH = os.path.join(current_dir, "benchmark_baseline.json")
+# Seconds of audio per cue in a typical ASMR transcript
+CUE_SECONDS = 2.5
+# Differences below this are timer noise, whatever the ratio
+NOISE_FLOOR = 0.002
+NOISE_LINES = ["はぁ…", "ん…", "あっ", "ふぅ…", "んっ…"]
+
+def synthetic_corpus(hours, rng, dictionary):
+    """Cues of a transcript `hours` long: sentences, breathing streaks and the odd loop"""
+    n_cues = int(hours * 3600 / CUE_SECONDS)
+    texts = synthetic_lines(n_cues, rng, dictionary)
+    entries = []
+    for i, text in enumerate(texts):
+        r = rng.random()
+        if r < 0.15:
+            text = rng.choice(NOISE_LINES)
+        elif r < 0.17:
+            text = rng.choice(["ああ", "はぁ", "気持ち"]) * rng.randint(3, 12)
+        elif r < 0.5:
+            cut = rng.randint(1, len(text) - 1)
+            text = text[:cut] + rng.choice("。！？") + text[cut:] + "。"
+        start = int(i * CUE_SECONDS * 1000)
+        entries.append(Cue(start, start + int(CUE_SECONDS * 1000) - 100, text))
+    return entries
+
+class BenchContext(JobContext):
+    """JobContext over a scratch directory, without hashing or touching core/cache"""
+
+    def __init__(self, work_dir, shared):
+        super().__init__(os.path.join(work_dir, "corpus.wav"), shared)
+        # The paths below it follow from the cache entry
+        self._cache_dir = work_dir
+        self.final_output = os.path.join(work_dir, "corpus.lrc")
+
+def best_time(run, setup=None, repeat=3):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def suite_cases(work_dir, entries, dictionary):
+    """(name, run, setup) for every step; setup runs untimed before each repetition"""
+    ctx = BenchContext(work_dir, {"asmr_dict": dictionary, "temp_dict": []})
+    write_cues(ctx.raw_path, entries)
+    write_cues(ctx.translated_path, entries)
+    open(ctx.input_file, 'wb').close()
+
+    replace_map, phonetic_map, noise_keywords = _2_correct.load_correction_data(ctx)
+    texts = [e.text for e in entries]
+    full_text = "\n".join(texts)
+    segments = [SimpleNamespace(start=i * CUE_SECONDS, end=(i + 1) * CUE_SECONDS, text=t) for i, t in enumerate(texts)]
+
+    warm = ReadingCache(os.path.join(work_dir, "warm.db"))
+    warm.tokens("")  # loads the pykakasi dictionaries once for every case
+    engine = CorrectionEngine(replace_map, phonetic_map, warm)
+    for t in texts:
+        engine.phonetic_replace(t)  # every reading in the warm memo
+    state = {}
+
+    def fresh_readings():
+        # Cold memo, as for a transcript that was never corrected before
+        name = f"cold_{len(os.listdir(work_dir))}.db"
+        readings = ReadingCache(os.path.join(work_dir, name))
+        readings.kks = warm.kks
+        return readings
+
+    def cold_engine():
+        state['engine'] = CorrectionEngine(replace_map, phonetic_map, fresh_readings())
+
+    def cold_context():
+        _2_correct.are_similar.cache_clear()
+        remove(ctx.corrected_path)
+        ctx.shared.pop("correction_engine", None)
+        ctx.shared["readings"] = fresh_readings()
+
+    def quiet(fn):
+        def run():
+            with contextlib.redirect_stdout(io.StringIO()):
+                fn(ctx)
+        return run
+
+    return [
+        ("read_cues", lambda: read_cues(ctx.raw_path), None),
+        ("build_engine", lambda: CorrectionEngine(replace_map, phonetic_map, warm), None),
+        ("literal_replace", lambda: [engine.literal_replace(t) for t in texts], None),
+        ("phonetic_replace", lambda: [state['engine'].phonetic_replace(t) for t in texts], cold_engine),
+        ("phonetic_replace_memo", lambda: [engine.phonetic_replace(t) for t in texts], None),
+        ("fold_entries", lambda: list(_2_correct.fold_entries((Cue(0, 0, t) for t in texts), noise_keywords)),
+         _2_correct.are_similar.cache_clear),
+        ("process_correction", quiet(lambda c: _2_correct.process_correction(c.raw_path, c)), cold_context),
+        ("split_by_sentence_end", lambda: [_1_whisper.split_by_sentence_end(s) for s in segments], None),
+        ("fold_repetitions", lambda: [fold_repetitions(t) for t in texts], None),
+        ("load_filtered_glossary", lambda: _3_translate.load_filtered_glossary(full_text, dictionary), None),
+        ("lrc_output", quiet(_4_output.main), lambda: remove(ctx.final_output)),
+    ]
+
+def load_baseline(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def bench_suite(args):
+    rng = random.Random(0)
+    dictionary = synthetic_dictionary(args.terms, rng)
+    for e in dictionary:
+        e["trans"] = f"译{e['term']}"
+    dictionary += [{"term": t, "type": "noise"} for t in NOISE_LINES]
+    entries = synthetic_corpus(args.hours, rng, dictionary)
+    corpus = {"hours": args.hours, "terms": args.terms, "cues": len(entries)}
+
+    results = {}
+    work_dir = tempfile.mkdtemp()
+    try:
+        for name, run, setup in suite_cases(work_dir, entries, dictionary):
+            seconds = best_time(run, setup, args.repeat)
+            results[name] = {"seconds": seconds, "us_per_cue": seconds / len(entries) * 1e6}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = load_baseline(args.baseline)
+    reference = baseline["results"] if baseline else {}
+    if baseline and baseline.get("corpus") != corpus:
+        print(f"Note: baseline corpus {baseline.get('corpus')} differs from {corpus}; comparing per cue")
+
+    print(f"{len(entries)} cues ({args.hours} h), {args.terms} terms")
+    print(f"{'step':<24} {'best s':>8} {'us/cue':>9} {'s/audio h':>10} {'baseline':>9} {'change':>8}")
+    regressions = []
+    for name, r in results.items():
+        base = reference.get(name)
+        change = ""
+        if base:
+            ratio = r["us_per_cue"] / base["us_per_cue"] if base["us_per_cue"] else 1.0
+            change = f"{(ratio - 1) * 100:+.0f}%"
+            # Absolute slowdown on this corpus, so microsecond steps do not flap
+            slower = (r["us_per_cue"] - base["us_per_cue"]) * len(entries) / 1e6
+            if ratio > 1 + args.threshold and slower > NOISE_FLOOR:
+                regressions.append(name)
+                change += " !"
+        base_us = f"{base['us_per_cue']:.1f}" if base else "-"
+        print(f"{name:<24} {r['seconds']:>8.3f} {r['us_per_cue']:>9.1f} {r['seconds'] / args.hours:>10.3f} "
+              f"{base_us:>9} {change:>8}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.platform(),
+                "corpus": corpus,
+                "results": results,
+            }, f, indent=2)
+        print(f"Baseline saved: {args.baseline}")
+    elif not baseline:
+        print("No baseline yet; run with --save-baseline to store one")
+
+    if regressions:
+        print(f"REGRESSION beyond {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+STUB_SERVER = """\
+import json, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+args = sys.argv[1:]
+model, port, slots = args[args.index("-m") + 1], int(args[args.index("--port") + 1]), int(args[args.index("-np") + 1])
+loaded = time.monotonic() + {load_s}
+free_slots = threading.Semaphore(slots)
+MARK = "将下面的文本从日文翻译成简体中文：\\n"
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        ready = time.monotonic() >= loaded
+        if self.path == "/health":
+            self.reply(*((200, {{"status": "ok"}}) if ready else (503, {{"error": {{"message": "Loading model"}}}})))
+        elif self.path == "/props" and ready:
+            self.reply(200, {{"model_path": model, "total_slots": slots}})
+        else:
+            self.reply(503, {{}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/tokenize":
+            self.reply(200, {{"tokens": list(range(len(body["content"])))}})
+            return
+        # /completion: one slot per request for {latency_s} s, echoing the lines to translate
+        prompt = body["prompt"]
+        text = prompt.split(MARK)[-1].split("<|im_end|>")[0] if MARK in prompt else ""
+        with free_slots:
+            time.sleep({latency_s})
+        content = "\\n".join("译" + line for line in text.split("\\n") if line)
+        self.reply(200, {{"content": content, "timings": {{"prompt_n": len(prompt), "predicted_n": len(content)}}}})
+
+ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+"""
+
+def stub_llama(work_dir, load_s, latency_s=0.0):
+    """A llama-server stand-in and two small model files.
+
+    It answers health and props, /tokenize with one token per character, and
+    /completion after `latency_s` per request on one of its -np slots.
+    """
+    exe = os.path.join(work_dir, "llama-server")
+    with open(exe, 'w', encoding='utf-8') as f:
+        f.write(f"#!{sys.executable}\n" + STUB_SERVER.format(load_s=load_s, latency_s=latency_s))
+    os.chmod(exe, 0o755)
+    models = []
+    for name in ("qwen.gguf", "sakura.gguf"):
+        path = os.path.join(work_dir, name)
+        with open(path, 'wb') as f:
+            f.truncate(1 << 20)
+        models.append(path)
+    return exe, models
+
+def translate_timed(pool, model, batches, parallel):
+    """Translated lines of `batches` on a server with `parallel` slots, and the seconds it took"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = pool.acquire(model, parallel)
+    llm = LocalLLM(port=server.port, pool_size=max(8, parallel))
+    try:
+        start = time.perf_counter()
+        results = [line for _, batch in _3_translate.translate_batches(llm, batches, ("", "", ""), parallel)
+                   for line in batch]
+        return results, time.perf_counter() - start
+    finally:
+        llm.close()
+        pool.release(server)
+
+def bench_translate(args):
+    """Translation batches over 1 and --parallel slots of a stub with fixed latency"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        os.environ["LLAMA_SERVER_BIN"], models = stub_llama(work_dir, 0.1, args.latency)
+        lines = [{"text": f"台詞{i}です"} for i in range(args.lines)]
+        batches = [lines[i:i + _3_translate.BATCH_SIZE] for i in range(0, len(lines), _3_translate.BATCH_SIZE)]
+        pool = ServerPool(budget=0, base_port=free_port(), state_dir=work_dir)
+        times = {}
+        try:
+            for parallel in (1, args.parallel):
+                _, times[parallel] = translate_timed(pool, models[1], batches, parallel)
+                print(f"{parallel} slot(s): {times[parallel]:.2f}s")
+        finally:
+            with contextlib.redirect_stdout(io.StringIO()):
+                pool.close()
+        print(f"speedup {times[1] / times[args.parallel]:.1f}x on {args.parallel} slots "
+              f"({len(batches)} batches, {args.latency}s each)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+def free_port():
+    """A port nothing listens on right now; servers count up from it"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def pool_run(pool, plan, keep_alive=False):
+    """Acquire and release each (model, parallel) of `plan` in turn: (starts, reuses, seconds)"""
+    out = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(out):
+            for model, parallel in plan:
+                pool.release(pool.acquire(model, parallel))
+    finally:
+        with contextlib.redirect_stdout(out):
+            pool.close(keep_alive=keep_alive)
+    log = out.getvalue()
+    return log.count("Starting Engine"), log.count("Reusing Engine"), time.perf_counter() - start
+
+def bench_pool(args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        if args.stub is not None:
+            os.environ["LLAMA_SERVER_BIN"], models = stub_llama(work_dir, args.stub)
+        else:
+            models = [get_qwen_model(), get_sakura_model()]
+        plan = [(models[i % 2], 1 if i % 2 == 0 else args.parallel) for i in range(2 * args.rounds)]
+        fits_both = sum(estimate_bytes(m, p) for m, p in set(plan))
+        # Servers and their state files of this benchmark only, never those of a real run
+        port = args.port or free_port()
+
+        def pool(budget):
+            return ServerPool(budget=budget, base_port=port, state_dir=work_dir)
+
+        print(f"{len(plan)} requests alternating {', '.join(os.path.basename(m) for m in models)}")
+        print(f"{'budget':<22} {'starts':>7} {'reuses':>7} {'seconds':>9}")
+        for label, result in (
+            ("one model", pool_run(pool(0), plan)),
+            ("both models", pool_run(pool(fits_both), plan)),
+            ("kept alive", pool_run(pool(fits_both), plan[1:2], keep_alive=True)),
+            ("next run", pool_run(pool(fits_both), plan)),
+        ):
+            print(f"{label:<22} {result[0]:>7} {result[1]:>7} {result[2]:>9.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+class ModelHost:
+    """Local stand-in for a model host, on a random port.
+
+    /resolve redirects to /blob like Hugging Face, announcing X-Linked-Size and
+    X-Linked-ETag; /blob honours Range. The first `drops` GETs of /blob stop
+    halfway. With `expire_every`, the signature in the redirect changes after
+    that many GETs of /blob and older ones get 403, like an expired signed URL.
+    /plain has neither HEAD nor Range support.
+    """
+
+    def __init__(self, data, sha256=None, drops=0, expire_every=0):
+        self.data = data
+        self.sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        self.drops = drops
+        self.expire_every = expire_every
+        self.signature = 0
+        self.gets = 0
+        self.expired = 0
+        self.sent = 0
+        self.lock = threading.Lock()
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                path, _, query = self.path.partition("?")
+                if path == "/resolve":
+                    self.send_response(302)
+                    self.send_header("Location", f"/blob?sig={host.signature}")
+                    self.send_header("X-Linked-Size", str(len(host.data)))
+                    self.send_header("X-Linked-ETag", f'"{host.sha256}"')
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if path == "/blob" and body and host.expire_every:
+                    with host.lock:
+                        stale = query != f"sig={host.signature}"
+                        host.expired += stale
+                        if not stale:
+                            host.gets += 1
+                            if host.gets % host.expire_every == 0:
+                                host.signature += 1
+                    if stale:
+                        self.send_response(403)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                if path == "/plain" and not body:
+                    self.send_response(405)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = 0, len(host.data)
+                ranged = path == "/blob" and self.headers.get("Range")
+                if ranged:
+                    first, last = ranged.split("=")[1].split("-")
+                    start, end = int(first), int(last) + 1 if last else len(host.data)
+                self.send_response(206 if ranged else 200)
+                if ranged:
+                    self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(host.data)}")
+                if path == "/blob":
+                    self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start))
+                self.end_headers()
+                if not body:
+                    return
+                with host.lock:
+                    drop = host.drops > 0
+                    host.drops -= drop
+                if drop:
+                    end = start + (end - start) // 2
+                try:
+                    self.wfile.write(host.data[start:end])
+                except OSError:
+                    return
+                with host.lock:
+                    host.sent += end - start
+                if drop:
+                    self.close_connection = True
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def fetch_model(host, path, dest, segments):
+    """downloader.download() from `host`: (ok, seconds, printed lines)"""
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        ok = downloader.download(host.url + path, dest, os.path.basename(dest), segments)
+    return ok, time.perf_counter() - start, out.getvalue().splitlines()
+
+def bench_download(args):
+    data = os.urandom(int(args.size_mb * (1 << 20)))
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f"{args.size_mb} MB file, two dropped connections")
+        for segments in (1, args.segments):
+            host = ModelHost(data, drops=2)
+            try:
+                ok, seconds, lines = fetch_model(host, "/resolve", os.path.join(work_dir, f"seg{segments}.gguf"), segments)
+            finally:
+                host.close()
+            progress = sum(line.startswith("PROGRESS:") for line in lines)
+            print(f"{segments} segment(s): {seconds:.2f}s, {progress} progress lines{'' if ok else ', FAILED'}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="AISMR pipeline benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("normalize", help="compare audio normalization engines")
+    p.add_argument("media", help="audio or video file to normalize")
+    p.add_argument("--runs", type=int, default=1)
+    p.add_argument("--tolerance", type=float, default=1.0, help="allowed integrated loudness difference in LU")
+    p.set_defaults(func=bench_normalize)
+
+    p = sub.add_parser("correct", help="dictionary correction scaling")
+    p.add_argument("--lines", type=int, nargs="+", default=[1000, 2000, 5000])
+    p.add_argument("--terms", type=int, nargs="+", default=[20, 200, 2000])
+    p.set_defaults(func=bench_correct)
+
+    p = sub.add_parser("kernels", help="repetition folding and similarity on adversarial input")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 4000, 16000])
+    p.set_defaults(func=bench_kernels)
+
+    p = sub.add_parser("suite", help="text stages on a long synthetic transcript, against a baseline")
+    p.add_argument("--hours", type=float, default=3.0, help="length of the synthetic audio")
+    p.add_argument("--terms", type=int, default=500, help="dictionary entries")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    p.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown per cue, 0.25 = 25%%")
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser("pool", help="LLM server starts with and without a memory budget")
+    p.add_argument("--rounds", type=int, default=5, help="Qwen + Sakura request pairs")
+    p.add_argument("--parallel", type=int, default=2, help="slots of the Sakura server")
+    p.add_argument("--port", type=int, default=0, help="first server port (default: a free one)")
+    p.add_argument("--stub", type=float, metavar="SECONDS", help="use a stand-in server that loads in SECONDS")
+    p.set_defaults(func=bench_pool)
+
+    p = sub.add_parser("translate", help="translation batches across server slots, against a stub with latency")
+    p.add_argument("--lines", type=int, default=80)
+    p.add_argument("--parallel", type=int, default=4)
+    p.add_argument("--latency", type=float, default=0.2, help="seconds the stub takes per request")
+    p.set_defaults(func=bench_translate)
+
+    p = sub.add_parser("download", help="resumable, verified model download against a local server")
+    p.add_argument("--size-mb", type=float, default=128)
+    p.add_argument("--segments", type=int, default=downloader.SEGMENTS)
+    p.set_defaults(func=bench_download)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Size and last-access index of core/cache, kept in cache/index.json.
+
+    {"total": bytes, "shared": bytes,
+     "entries": {"<entry>": {"last_access": t, "size": bytes,
+                             "artifacts": {"<file>": {"size": bytes, "mtime": ns, "last_access": t}}}}}
+
+`total` covers every file under the cache root, so the UI can show the cache
+size without walking the tree. `shared` is the part of it in files at the top
+of the root: the translation memory, reading cache and hash memo serve every
+input, bound their own size and are never evicted, so they are left out of
+the budget. With a byte budget (CACHE_BUDGET_MB), eviction first drops
+rebuildable artifacts (normalized audio, leftover .part files) of the
+per-file entries in LRU order, then whole entries in LRU order, whose
+transcripts and translations are the expensive part.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from utils import CACHE_ROOT, replace_file
+
+INDEX_FILE = "index.json"
+# Large and rebuilt from the source by the prepare stage in seconds
+REBUILDABLE = ("audio_16k_norm.pcm",)
+
+def is_rebuildable(name):
+    return name in REBUILDABLE or name.endswith(".part")
+
+def budget_bytes():
+    """Configured budget from CACHE_BUDGET_MB; 0 means unlimited"""
+    try:
+        return max(0, int(float(os.environ.get("CACHE_BUDGET_MB", 0)) * 1024 * 1024))
+    except ValueError:
+        return 0
+
+class CacheIndex:
+    def __init__(self, root=CACHE_ROOT):
+        self.root = root
+        self.path = os.path.join(root, INDEX_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        except:
+            self.data = {}
+        self.data.setdefault("entries", {})
+
+    def _measure(self, cache_dir, when, previous=None, reads=()):
+        """Entry record; artifacts keep their previous last_access unless written since or in `reads`"""
+        previous = previous or {}
+        artifacts = {}
+        for fname in os.listdir(cache_dir):
+            try:
+                st = os.stat(os.path.join(cache_dir, fname))
+            except OSError:
+                continue
+            prev = previous.get(fname)
+            unchanged = prev and prev.get("size") == st.st_size and prev.get("mtime") == st.st_mtime_ns
+            last_access = prev["last_access"] if unchanged and fname not in reads else when
+            artifacts[fname] = {"size": st.st_size, "mtime": st.st_mtime_ns, "last_access": last_access}
+        return {"last_access": when, "size": sum(a["size"] for a in artifacts.values()), "artifacts": artifacts}
+
+    def touch(self, cache_dir, reads=()):
+        """Re-measure one entry and mark it as used now, along with the artifacts
+        written since the last touch and the ones in `reads` (paths)"""
+        if not os.path.isdir(cache_dir):
+            return
+        name = os.path.basename(os.path.normpath(cache_dir))
+        reads = {os.path.basename(p) for p in reads}
+        with self.lock:
+            previous = self.data["entries"].get(name, {}).get("artifacts")
+            self.data["entries"][name] = self._measure(cache_dir, time.time(), previous, reads)
+
+    def refresh(self):
+        """Sync with the disk: forget what was removed behind our back (e.g. by the app's
+        cleanup) and adopt unindexed entries, dated by their modification time."""
+        with self.lock:
+            entries = self.data["entries"]
+            if os.path.isdir(self.root):
+                for name in os.listdir(self.root):
+                    entry_dir = os.path.join(self.root, name)
+                    if name not in entries and os.path.isdir(entry_dir):
+                        entries[name] = self._measure(entry_dir, os.path.getmtime(entry_dir))
+            for name in list(entries):
+                entry_dir = os.path.join(self.root, name)
+                if not os.path.isdir(entry_dir):
+                    del entries[name]
+                    continue
+                artifacts = entries[name]["artifacts"]
+                for fname in list(artifacts):
+                    if not os.path.exists(os.path.join(entry_dir, fname)):
+                        del artifacts[fname]
+                entries[name]["size"] = sum(a["size"] for a in artifacts.values())
+
+    def loose_bytes(self):
+        """Files at the top of the cache root (hash memo, translation memory)"""
+        size = 0
+        if not os.path.isdir(self.root):
+            return 0
+        for fname in os.listdir(self.root):
+            path = os.path.join(self.root, fname)
+            if fname != INDEX_FILE and os.path.isfile(path):
+                try:
+                    size += os.path.getsize(path)
+                except OSError:
+                    pass
+        return size
+
+    def entries_bytes(self):
+        """Size of the per-file entries, the part CACHE_BUDGET_MB applies to"""
+        return sum(e["size"] for e in self.data["entries"].values())
+
+    def total(self):
+        return self.entries_bytes() + self.loose_bytes()
+
+    def save(self):
+        self.refresh()
+        with self.lock:
+            shared = self.loose_bytes()
+            self.data["shared"] = shared
+            self.data["total"] = self.entries_bytes() + shared
+            if not os.path.isdir(self.root):
+                return
+            tmp = f"{self.path}.{os.getpid()}.part"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            replace_file(tmp, self.path)
+
+    def evict(self, budget, protect=()):
+        """Remove least recently used data until the per-file entries fit in `budget` bytes.
+
+        Entries named in `protect` (the jobs of the current run) are never touched.
+        Returns the paths that were removed.
+        """
+        self.refresh()
+        total = self.entries_bytes()
+        removed = []
+        if not budget or total <= budget:
+            return removed
+
+        protect = {os.path.basename(os.path.normpath(p)) for p in protect}
+        with self.lock:
+            entries = self.data["entries"]
+            candidates = sorted(
+                (a["last_access"], name, fname)
+                for name, e in entries.items() if name not in protect
+                for fname, a in e["artifacts"].items() if is_rebuildable(fname)
+            )
+            for _, name, fname in candidates:
+                if total <= budget:
+                    break
+                path = os.path.join(self.root, name, fname)
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size = entries[name]["artifacts"].pop(fname)["size"]
+                entries[name]["size"] -= size
+                total -= size
+                removed.append(path)
+
+            for _, name in sorted((e["last_access"], name) for name, e in entries.items() if name not in protect):
+                if total <= budget:
+                    break
+                path = os.path.join(self.root, name)
+                shutil.rmtree(path, ignore_errors=True)
+                if os.path.exists(path):
+                    continue
+                total -= entries.pop(name)["size"]
+                removed.append(path)
+        return removed
@@ -0,0 +1,154 @@
+"""Dictionary correction built once per run and applied to each line in one pass.
+
+Literal `wrongs` go through an Aho-Corasick automaton, so the cost per line
+does not grow with the size of the dictionary. Readings go into a trie of
+acoustic fingerprints that is walked across windows of consecutive pykakasi
+tokens, so a term split over token boundaries is still found. Tokens come from
+a ReadingCache, so a line seen before is not converted again.
+"""
+import re
+
+FINGERPRINT_TABLE = str.maketrans({
+    'b': 'h', 'p': 'h',
+    'd': 't',
+    'g': 'k',
+    'z': 's', 'j': 's'
+})
+# Longest run of pykakasi tokens a single reading may span
+MAX_TOKEN_WINDOW = 4
+_TERM = None
+
+def fingerprint_letters(text):
+    """Lowercase latin letters with similar consonants merged (not yet deduplicated)"""
+    return re.sub(r'[^a-z]', '', text.lower()).translate(FINGERPRINT_TABLE)
+
+def get_acoustic_fingerprint(text):
+    if not text: return ""
+    return re.sub(r'([a-z])\1+', r'\1', fingerprint_letters(text))
+
+def compress_repetitions(text):
+    return re.sub(r'([ー〜～…\.!? ])\1{2,}', r'\1\1', text)
+
+class AhoCorasick:
+    """Literal multi-pattern matcher with the same leftmost-longest choice as a
+    regex alternation of the patterns sorted longest first."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.length = [0]   # pattern length if a pattern ends at the node
+        self.out = [0]      # nearest node on the fail chain where a pattern ends
+        for p in patterns:
+            if p:
+                self._insert(p)
+        self._link()
+
+    def _insert(self, pattern):
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.length.append(0)
+                self.out.append(0)
+            node = nxt
+        self.length[node] = len(pattern)
+
+    def _link(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                fail = self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = fail if self.length[fail] else self.out[fail]
+                queue.append(nxt)
+
+    def longest_at(self, text):
+        """{start: length of the longest pattern starting there}"""
+        goto, fail, length, out = self.goto, self.fail, self.length, self.out
+        longest = {}
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            node = state if length[state] else out[state]
+            while node:
+                start = i - length[node] + 1
+                if length[node] > longest.get(start, 0):
+                    longest[start] = length[node]
+                node = out[node]
+        return longest
+
+    def replace(self, text, mapping):
+        longest = self.longest_at(text)
+        if not longest:
+            return text
+        result = []
+        pos = 0
+        for start in sorted(longest):
+            if start < pos:
+                continue
+            end = start + longest[start]
+            result.append(text[pos:start])
+            result.append(mapping[text[start:end]])
+            pos = end
+        result.append(text[pos:])
+        return "".join(result)
+
+class CorrectionEngine:
+    def __init__(self, replace_map, phonetic_map, readings):
+        self.replace_map = replace_map
+        self.matcher = AhoCorasick(replace_map) if replace_map else None
+        self.readings = readings
+        self.trie = {}
+        for fp, term in phonetic_map.items():
+            node = self.trie
+            for ch in fp:
+                node = node.setdefault(ch, {})
+            node[_TERM] = term
+
+    def literal_replace(self, text):
+        if not self.matcher: return text
+        return self.matcher.replace(text, self.replace_map)
+
+    def phonetic_replace(self, text):
+        """Replace the longest window of tokens (from the left) whose joined reading
+        has the fingerprint of a dictionary term"""
+        if not self.trie or not text.strip(): return text
+        tokens = self.readings.tokens(text)
+        letters = [t[2] for t in tokens]
+        result = []
+        k = 0
+        while k < len(tokens):
+            node = self.trie
+            last = ""
+            match = None
+            for j in range(k, min(k + MAX_TOKEN_WINDOW, len(tokens))):
+                # Tokens without letters (punctuation, symbols) end a window
+                if not letters[j]: break
+                for ch in letters[j]:
+                    if ch == last: continue
+                    node = node.get(ch)
+                    last = ch
+                    if node is None: break
+                if node is None: break
+                if _TERM in node:
+                    match = (j, node[_TERM])
+            if match:
+                result.append(match[1])
+                k = match[0] + 1
+            else:
+                result.append(tokens[k][0])
+                k += 1
+        return "".join(result)
+
+    def correct(self, text):
+        text = self.literal_replace(text)
+        text = self.phonetic_replace(text)
+        return compress_repetitions(text)
@@ -0,0 +1,264 @@
+"""Resumable model downloads.
+
+A download is written to `<dest>.part`, with the progress of each byte range
+in `<dest>.part.json`, and only renamed to `dest` once its size (and sha256,
+where the server publishes one) checks out, so an interrupted download is
+never taken for a model. The next attempt resumes with HTTP Range requests.
+Large files are fetched as up to DOWNLOAD_SEGMENTS ranges in parallel.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from utils import ensure_directory, replace_file
+
+SEGMENTS = max(1, int(os.environ.get("DOWNLOAD_SEGMENTS", 4)))
+MIN_SEGMENT = 32 << 20
+RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 5))
+BLOCK = 1 << 20
+TIMEOUT = (10, 60)
+PROGRESS_INTERVAL = 0.5
+STATE_INTERVAL = 2.0
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+class DownloadError(Exception):
+    pass
+
+class Progress:
+    """PROGRESS: lines when the percentage moves, at most every PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.shown = None
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            self._show()
+
+    def finish(self):
+        with self.lock:
+            self._show(force=True)
+
+    def _show(self, force=False):
+        if not self.total:
+            return
+        percent = min(100, self.done * 100 // self.total)
+        now = time.monotonic()
+        if percent != self.shown and (force or now - self.last >= PROGRESS_INTERVAL):
+            print(f"PROGRESS: {percent}", flush=True)
+            self.shown, self.last = percent, now
+
+def probe(session, url):
+    """Final URL, size, range support and published sha256 of `url`"""
+    info = {'source': url, 'url': url, 'size': None, 'sha256': None, 'ranges': False}
+    try:
+        res = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        return info
+    if res.status_code >= 400:
+        # No HEAD support; a plain GET still works
+        return info
+    for r in res.history + [res]:
+        # Hugging Face describes the LFS object on its redirect: X-Linked-Size, X-Linked-ETag (sha256)
+        linked = r.headers.get('x-linked-etag', '').lower().replace('w/', '').strip('"')
+        if SHA256.match(linked):
+            info['sha256'] = linked
+        if r.headers.get('x-linked-size', '').isdigit():
+            info['size'] = int(r.headers['x-linked-size'])
+    if info['size'] is None and res.headers.get('content-length', '').isdigit():
+        info['size'] = int(res.headers['content-length'])
+    info['url'] = res.url
+    info['ranges'] = res.headers.get('accept-ranges', '').lower() == 'bytes'
+    return info
+
+def plan_segments(size, count):
+    """[start, end, done] byte ranges covering `size`, none smaller than MIN_SEGMENT"""
+    count = max(1, min(count, size // MIN_SEGMENT))
+    step = -(-size // count) or 1
+    return [[start, min(start + step, size), 0] for start in range(0, size, step)]
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BLOCK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class RangedDownload:
+    """Fill a preallocated .part file range by range, recording progress for resume"""
+
+    def __init__(self, session, remote, part_path, segments):
+        self.session = session
+        self.source = remote['source']
+        self.url = remote['url']
+        self.part_path = part_path
+        self.state_path = part_path + ".json"
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.last_save = 0.0
+        self.state = self._resume(remote)
+        if self.state is None:
+            self.state = {'size': remote['size'], 'sha256': remote['sha256'],
+                          'segments': plan_segments(remote['size'], segments)}
+            with open(part_path, 'wb') as f:
+                f.truncate(remote['size'])
+            self.save(force=True)
+        else:
+            done = sum(seg[2] for seg in self.state['segments'])
+            print(f"Resuming download at {done * 100 // max(1, remote['size'])}%", flush=True)
+        self.progress = Progress(remote['size'], sum(seg[2] for seg in self.state['segments']))
+
+    def _resume(self, remote):
+        """The recorded progress, if it belongs to the same remote file and .part"""
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if (state['size'], state['sha256']) != (remote['size'], remote['sha256']):
+                return None
+            if os.path.getsize(self.part_path) != state['size']:
+                return None
+            return state
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_save < STATE_INTERVAL:
+                return
+            self.last_save = now
+            tmp = f"{self.state_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f)
+            replace_file(tmp, self.state_path)
+
+    def run(self):
+        pending = [seg for seg in self.state['segments'] if seg[0] + seg[2] < seg[1]]
+        try:
+            if len(pending) > 1:
+                with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                    futures = [pool.submit(self.fetch, seg) for seg in pending]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except BaseException:
+                        # Before the pool waits for the other segments
+                        self.stop.set()
+                        raise
+            elif pending:
+                self.fetch(pending[0])
+        finally:
+            self.save(force=True)
+        self.progress.finish()
+
+    def fetch(self, seg):
+        """Download one segment, retrying from where the last attempt stopped"""
+        start, end = seg[0], seg[1]
+        for attempt in range(RETRIES + 1):
+            try:
+                self._fetch_once(seg)
+                return
+            except (requests.RequestException, DownloadError) as e:
+                if self.stop.is_set() or attempt == RETRIES:
+                    raise DownloadError(f"bytes {start + seg[2]}-{end - 1}: {e}")
+                if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code in (401, 403):
+                    # Signed redirect targets expire; ask the original URL for a fresh one
+                    self.url = probe(self.session, self.source)['url']
+                if self.stop.wait(min(2 ** attempt, 30)):
+                    raise DownloadError("cancelled")
+
+    def _fetch_once(self, seg):
+        start, end = seg[0], seg[1]
+        headers = {'Range': f"bytes={start + seg[2]}-{end - 1}"}
+        with self.session.get(self.url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+            res.raise_for_status()
+            if res.status_code != 206:
+                raise DownloadError("server ignored the range request")
+            with open(self.part_path, 'r+b') as f:
+                f.seek(start + seg[2])
+                for chunk in res.iter_content(chunk_size=BLOCK):
+                    if self.stop.is_set():
+                        raise DownloadError("cancelled")
+                    chunk = chunk[:end - start - seg[2]]
+                    f.write(chunk)
+                    seg[2] += len(chunk)
+                    self.progress.add(len(chunk))
+                    self.save()
+                    if start + seg[2] >= end:
+                        return
+        if start + seg[2] < end:
+            raise DownloadError("connection closed early")
+
+def fetch_whole(session, remote, part_path):
+    """Plain streaming GET for servers without size or range support; restarts from zero"""
+    progress = Progress(remote['size'])
+    with session.get(remote['url'], stream=True, timeout=TIMEOUT) as res:
+        res.raise_for_status()
+        if progress.total is None and res.headers.get('content-length', '').isdigit():
+            progress.total = int(res.headers['content-length'])
+        with open(part_path, 'wb') as f:
+            for chunk in res.iter_content(chunk_size=BLOCK):
+                f.write(chunk)
+                progress.add(len(chunk))
+    progress.finish()
+
+def verify(part_path, remote, label):
+    """Check the finished .part against the advertised size and sha256"""
+    size = os.path.getsize(part_path)
+    if remote['size'] is not None and size != remote['size']:
+        raise DownloadError(f"{label}: expected {remote['size']} bytes, got {size}")
+    if remote['sha256']:
+        print(f"STATUS: Verifying {label}...", flush=True)
+        actual = file_sha256(part_path)
+        if actual != remote['sha256']:
+            raise DownloadError(f"{label}: sha256 mismatch ({actual} != {remote['sha256']})")
+
+def discard(part_path):
+    for path in (part_path, part_path + ".json"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def download(url, dest_path, label, segments=SEGMENTS):
+    """Download `url` to `dest_path`, resuming an earlier attempt; False on failure"""
+    if os.path.exists(dest_path):
+        return True
+
+    ensure_directory(os.path.dirname(dest_path))
+    print(f"STATUS: Downloading {label}...", flush=True)
+
+    part_path = dest_path + ".part"
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=segments)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    try:
+        remote = probe(session, url)
+        if remote['size'] is not None and remote['ranges']:
+            RangedDownload(session, remote, part_path, segments).run()
+        else:
+            fetch_whole(session, remote, part_path)
+        try:
+            verify(part_path, remote, label)
+        except DownloadError:
+            # Corrupt data cannot be resumed
+            discard(part_path)
+            raise
+        replace_file(part_path, dest_path)
+        discard(part_path)
+    except Exception as e:
+        print(f"ERROR: {str(e)}", flush=True)
+        return False
+    finally:
+        session.close()
+    return True
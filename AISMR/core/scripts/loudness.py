@@ -0,0 +1,160 @@
+"""Block-wise loudness normalization for 16 kHz mono float32 audio.
+
+Integrated loudness follows ITU-R BS.1770 (K-weighting, 400 ms gating blocks
+with 75% overlap, -70 LUFS absolute and -10 LU relative gates). The K-weighting
+filter is applied as a power response on the spectrum of each 100 ms block, so
+the whole measurement is a handful of vectorized FFTs per chunk.
+"""
+import os
+import numpy as np
+
+SAMPLE_RATE = 16000
+TARGET_LUFS = -14.0
+CEILING_DB = -1.0
+MAX_GAIN_DB = 30.0
+
+BLOCK = SAMPLE_RATE // 10          # 100 ms, a quarter of a gating block
+PEAK_BLOCK = SAMPLE_RATE // 100    # 10 ms limiter resolution
+LIMITER_WINDOW = 5                 # limiter looks this many peak blocks ahead and behind
+
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+def _biquad_power(b, a, w):
+    z = np.exp(-1j * w)
+    h = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return np.abs(h) ** 2
+
+def k_weighting_power(n, sr=SAMPLE_RATE):
+    """|H|^2 of the BS.1770 pre-filter (high shelf + RLB high pass) at the rfft bins of n samples"""
+    w = 2 * np.pi * np.fft.rfftfreq(n, 1.0 / sr) / sr
+
+    # High shelf, +4 dB above ~1.7 kHz
+    gain_db, q, fc = 3.99984385397, 0.7071752369554193, 1681.9744509555319
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * np.pi * fc / sr
+    alpha = np.sin(w0) / (2 * q)
+    cos = np.cos(w0)
+    shelf_b = (A * ((A + 1) + (A - 1) * cos + 2 * np.sqrt(A) * alpha),
+               -2 * A * ((A - 1) + (A + 1) * cos),
+               A * ((A + 1) + (A - 1) * cos - 2 * np.sqrt(A) * alpha))
+    shelf_a = ((A + 1) - (A - 1) * cos + 2 * np.sqrt(A) * alpha,
+               2 * ((A - 1) - (A + 1) * cos),
+               (A + 1) - (A - 1) * cos - 2 * np.sqrt(A) * alpha)
+
+    # RLB high pass at ~38 Hz
+    q, fc = 0.5003270373253953, 38.13547087613982
+    w0 = 2 * np.pi * fc / sr
+    alpha = np.sin(w0) / (2 * q)
+    cos = np.cos(w0)
+    hp_b = ((1 + cos) / 2, -(1 + cos), (1 + cos) / 2)
+    hp_a = (1 + alpha, -2 * cos, 1 - alpha)
+
+    return _biquad_power(shelf_b, shelf_a, w) * _biquad_power(hp_b, hp_a, w)
+
+class LoudnessMeter:
+    """Accumulates K-weighted block energies and 10 ms peaks from a stream of samples"""
+    def __init__(self, sr=SAMPLE_RATE):
+        # Parseval for rfft: interior bins count twice; divide by n^2 for the mean square
+        weights = k_weighting_power(BLOCK, sr)
+        weights[1:-1] *= 2
+        self.weights = weights / (BLOCK * BLOCK)
+        self.energies = []
+        self.peaks = []
+        self.length = 0
+        self.pending = np.empty(0, dtype=np.float32)
+
+    def feed(self, samples):
+        self.length += len(samples)
+        if len(self.pending):
+            samples = np.concatenate([self.pending, samples])
+        full = len(samples) // BLOCK * BLOCK
+        self.pending = samples[full:].copy()
+        if full:
+            self._add_blocks(samples[:full].reshape(-1, BLOCK))
+
+    def _add_blocks(self, blocks, energy=True):
+        if energy:
+            spectrum = np.fft.rfft(blocks, axis=1)
+            self.energies.append((spectrum.real ** 2 + spectrum.imag ** 2) @ self.weights)
+        self.peaks.append(np.abs(blocks).reshape(-1, PEAK_BLOCK).max(axis=1))
+
+    def finish(self):
+        """Account for the trailing partial block (peaks only, like the BS.1770 gating)"""
+        if len(self.pending):
+            padded = np.zeros(BLOCK, dtype=np.float32)
+            padded[:len(self.pending)] = self.pending
+            self._add_blocks(padded.reshape(1, BLOCK), energy=False)
+            self.pending = np.empty(0, dtype=np.float32)
+
+    def integrated(self):
+        """Gated integrated loudness in LUFS, or None for silence"""
+        if not self.energies:
+            return None
+        energies = np.concatenate(self.energies)
+        if len(energies) < 4:
+            return None
+        gating = np.convolve(energies, np.ones(4) / 4, mode="valid")
+        with np.errstate(divide="ignore"):
+            loudness = -0.691 + 10 * np.log10(gating)
+        gated = gating[loudness > ABSOLUTE_GATE]
+        if not len(gated):
+            return None
+        relative = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+        with np.errstate(divide="ignore"):
+            gated = gated[-0.691 + 10 * np.log10(gated) > relative]
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+    def block_peaks(self):
+        return np.concatenate(self.peaks) if self.peaks else np.empty(0, dtype=np.float32)
+
+def normalization_gain(loudness, target=TARGET_LUFS):
+    if loudness is None:
+        return 1.0
+    return 10 ** (min(target - loudness, MAX_GAIN_DB) / 20)
+
+def limiter_gains(peaks, gain, ceiling_db=CEILING_DB):
+    """Per 10 ms block gain: `gain`, reduced wherever the block would exceed the ceiling.
+
+    Each block takes the minimum over its neighbours, so a linear ramp between
+    block centers never rises above what any sample inside a block allows.
+    """
+    ceiling = 10 ** (ceiling_db / 20)
+    gains = np.minimum(gain, ceiling / np.maximum(peaks, 1e-9))
+    padded = np.pad(gains, LIMITER_WINDOW, mode="edge")
+    window = np.lib.stride_tricks.sliding_window_view(padded, 2 * LIMITER_WINDOW + 1)
+    return window.min(axis=1)
+
+def apply_gains(samples, start, gains):
+    """Scale samples[start:start+len] by block gains interpolated between block centers; returns int16"""
+    centers = (np.arange(len(gains)) + 0.5) * PEAK_BLOCK
+    g = np.interp(np.arange(start, start + len(samples)), centers, gains)
+    out = np.clip(samples * g, -1.0, 32767 / 32768)
+    return (out * 32768).astype(np.int16)
+
+def write_normalized(float_path, out_file, meter, target=TARGET_LUFS, chunk=SAMPLE_RATE * 60):
+    """Second pass over the float32 capture: gain to the target and limit peaks, writing s16le.
+
+    Returns (measured LUFS or None, applied gain in dB).
+    """
+    loudness = meter.integrated()
+    gain = normalization_gain(loudness, target)
+    gains = limiter_gains(meter.block_peaks(), gain)
+    if meter.length:
+        samples = np.memmap(float_path, dtype=np.float32, mode="r")
+        for start in range(0, len(samples), chunk):
+            out_file.write(apply_gains(samples[start:start + chunk], start, gains).tobytes())
+        del samples
+    return loudness, 20 * np.log10(gain)
+
+def measure_pcm(path, dtype=np.int16, chunk=SAMPLE_RATE * 60):
+    """Integrated loudness of a raw 16 kHz mono PCM file"""
+    if os.path.getsize(path) == 0:
+        return None
+    samples = np.memmap(path, dtype=dtype, mode="r")
+    scale = 32768.0 if dtype == np.int16 else 1.0
+    meter = LoudnessMeter()
+    for start in range(0, len(samples), chunk):
+        meter.feed(samples[start:start + chunk].astype(np.float32) / scale)
+    meter.finish()
+    return meter.integrated()
@@ -0,0 +1,96 @@
+"""Memo of pykakasi conversions shared by the prepare and correction stages.
+
+A line or term is converted once: its tokens (surface text, Hepburn reading and
+fingerprint letters) are kept in an in-process LRU in front of an SQLite table
+in the cache root, so repeated lines across the tracks of a work and across
+runs skip pykakasi entirely.
+"""
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from utils import CACHE_ROOT, ensure_directory
+from correction_engine import fingerprint_letters
+
+READINGS_PATH = os.path.join(CACHE_ROOT, "readings.db")
+READINGS_MAX_ENTRIES = int(os.environ.get("READINGS_MAX_ENTRIES", 500000))
+MEMORY_ENTRIES = 20000
+COMMIT_EVERY = 500
+
+class ReadingCache:
+    """Surface text -> [(orig, hepburn, letters), ...] with LRU bounds in memory and on disk"""
+
+    def __init__(self, path=READINGS_PATH, max_entries=READINGS_MAX_ENTRIES, memory_entries=MEMORY_ENTRIES):
+        ensure_directory(os.path.dirname(path))
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.kks = None
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS readings ("
+            "text TEXT PRIMARY KEY, tokens TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS readings_last_used ON readings (last_used)")
+        self.conn.commit()
+
+    def tokens(self, text):
+        with self.lock:
+            tokens = self.memory.get(text)
+            if tokens is not None:
+                self.memory.move_to_end(text)
+                self.hits += 1
+                return tokens
+
+            now = time.time()
+            row = self.conn.execute("SELECT tokens FROM readings WHERE text = ?", (text,)).fetchone()
+            if row:
+                self.hits += 1
+                tokens = [tuple(t) for t in json.loads(row[0])]
+                self.conn.execute("UPDATE readings SET last_used = ? WHERE text = ?", (now, text))
+            else:
+                self.misses += 1
+                if self.kks is None:
+                    import pykakasi
+                    self.kks = pykakasi.kakasi()
+                tokens = [(t['orig'], t['hepburn'], fingerprint_letters(t['hepburn'])) for t in self.kks.convert(text)]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO readings (text, tokens, last_used) VALUES (?, ?, ?)",
+                    (text, json.dumps(tokens, ensure_ascii=False), now)
+                )
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self._flush()
+
+            self.memory[text] = tokens
+            if len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+            return tokens
+
+    def reading(self, text):
+        """Lowercase Hepburn reading of `text`"""
+        return "".join(t[1] for t in self.tokens(text)).lower()
+
+    def _flush(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM readings WHERE rowid IN (SELECT rowid FROM readings ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self.conn.commit()
+        self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
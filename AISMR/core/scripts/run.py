@@ -1,6 +1,10 @@
-import subprocess
+import argparse
+import threading
 import sys
 import os
+import shutil
+import time
+from pathlib import Path
 
 current_script_dir = os.path.dirname(os.path.abspath(__file__))
 if current_script_dir not in sys.path:
@@ -10,9 +14,17 @@ os.environ["PYTHONPATH"] = current_script_dir + os.pathsep + os.environ.get("PYT
 os.environ["TQDM_DISABLE"] = "1"
 os.environ["PYTHONIOENCODING"] = "utf-8"
 
-from utils import MODELS_DIR, get_qwen_model, get_sakura_model, get_cache_dir, get_assets_context_path, get_assets_terms_path, get_final_output_path, PROMPTS_DIR
-from server_manager import ServerManager
-import glob
+from utils import MODELS_DIR, CACHE_ROOT, JobContext, collect_input_files, get_assets_context_path, get_assets_terms_path
+from whisper_worker import WhisperWorker
+from cache_index import CacheIndex, budget_bytes
+import telemetry
+from subtitles import follow_cues, parse_srt, write_cues
+from stage_cache import StageCache, digest
+import _0_prepare
+import _1_whisper
+import _2_correct
+import _3_translate
+import _4_output
 
 DEFAULT_INPUT = "test.flac"
 PORT = 8080
@@ -20,93 +32,370 @@ PORT = 8080
 os.environ["HF_HOME"] = os.path.join(MODELS_DIR, "huggingface")
 os.environ["LLM_PORT"] = str(PORT)
 
-def get_prompt_file_name():
-    """Get the prompt file name from prompts directory"""
-    if os.path.exists(PROMPTS_DIR):
-        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
-        if txt_files:
-            return os.path.basename(txt_files[0])
-    if os.path.exists("ReadMe.txt"):
-        return "ReadMe.txt"
-    return "default.txt"
-
-def run_script(script_name, args=[]):
-    print(f"--- RUNNING: {script_name} ---")
-    cmd = [sys.executable, script_name] + args
-    try:
-        subprocess.run(cmd, check=True, env=os.environ.copy())
-    except subprocess.CalledProcessError:
-        sys.exit(1)
+def run_stage(name, func, ctx):
+    """Run a stage function in this process; SystemExit from the stage is treated as its exit code"""
+    print(f"--- RUNNING: {name} ---")
+    sys.stdout.flush()
+    with telemetry.stage(name, ctx) as span:
+        try:
+            func(ctx)
+        except SystemExit as e:
+            span["ok"] = e.code in (None, 0)
+        except Exception as e:
+            print(f"ERROR: {name} failed: {e}")
+            span["ok"] = False
+        finally:
+            sys.stdout.flush()
+    return span["ok"]
+
+def stage_runner(name, func):
+    return lambda ctx: run_stage(name, func, ctx)
+
+def transcribe_with_worker(worker):
+    def runner(ctx):
+        print("--- RUNNING: _1_whisper.py ---")
+        with telemetry.stage("_1_whisper.py", ctx) as span:
+            span["ok"] = worker.transcribe(ctx.input_file)
+        return span["ok"]
+    return runner
+
+def transcribe_in_process():
+    return stage_runner("_1_whisper.py", _1_whisper.main)
 
 def file_valid(path):
     return os.path.exists(path) and os.path.getsize(path) > 0
 
-def main():
-    target_file = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+def run_phase(jobs, runner, failed, needs_run=None, reads=lambda ctx: ()):
+    """Run one stage over every job that is still pending; `reads(ctx)` are the cache files it reads"""
+    for ctx in jobs:
+        if ctx.input_file in failed:
+            continue
+        if needs_run is not None and not needs_run(ctx):
+            continue
+        print(f"Processing file: {ctx.input_file}")
+        sys.stdout.flush()
+        ok = runner(ctx)
+        ctx.cached("cache_index", CacheIndex).touch(ctx.cache_dir, reads(ctx))
+        if not ok:
+            print(f"ERROR: Processing failed for {ctx.input_file}")
+            sys.stdout.flush()
+            failed.add(ctx.input_file)
 
-    if not os.path.exists(target_file):
-        print(f"ERROR: Input file not found: {target_file}")
-        sys.exit(1)
+# A stage needs to run when its manifest entry no longer matches its inputs
+def needs_transcription(ctx):
+    return not ctx.stages.is_fresh("transcribe", ctx.raw_path, _1_whisper.transcription_inputs(ctx))
 
-    abs_input_path = os.path.abspath(target_file)
-    print(f"Processing file: {abs_input_path}")
-    sys.stdout.flush()
+def needs_correction(ctx):
+    return not ctx.stages.is_fresh("correct", ctx.corrected_path, _2_correct.correction_inputs(ctx))
 
-    final_output = get_final_output_path(abs_input_path)
-    if file_valid(final_output):
-        print(f"Final output already exists: {final_output}")
-        print("Skipping all processing.")
-        sys.exit(0)
+def needs_translation(ctx):
+    return not ctx.stages.is_fresh("translate", ctx.translated_path, _3_translate.translation_inputs(ctx))
 
-    cache_dir = get_cache_dir(abs_input_path)
-    print(f"Cache directory: {cache_dir}")
-    sys.stdout.flush()
+def is_up_to_date(ctx):
+    """Final output exists and nothing upstream of it changed.
 
-    prompt_file_name = get_prompt_file_name()
-    path_context = get_assets_context_path(prompt_file_name)
-    path_terms = get_assets_terms_path(prompt_file_name)
+    Without a manifest (cache cleaned up) an existing output is kept as before;
+    the output file itself is not compared so hand edits survive. A file not
+    hashed at its current path, size and mtime is not read just to look for a
+    manifest, so its output is kept too.
+    """
+    if not file_valid(ctx.final_output):
+        return False
+    known = ctx.known_cache_dir
+    if known is None or not StageCache(known).exists():
+        return True
+    return not (needs_transcription(ctx) or needs_correction(ctx) or needs_translation(ctx))
 
-    need_llm = not (file_valid(path_context) and file_valid(path_terms))
+def stream_file(ctx, transcribe):
+    """Transcribe one file while correcting and translating its finished segments"""
+    done = threading.Event()
+    outcome = {}
 
-    if need_llm:
-        server = ServerManager(PORT)
-        qwen_path = get_qwen_model()
-        server.start(qwen_path)
+    def transcribe_job():
         try:
-            run_script("_0_prepare.py", [abs_input_path])
+            outcome['ok'] = transcribe(ctx)
         finally:
-            server.stop()
+            done.set()
+
+    # Stale output (a crashed run's .part, or a raw.jsonl that is being redone)
+    # would otherwise be streamed before the new transcription starts writing
+    for path in (ctx.raw_path, ctx.raw_path + ".part"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    thread = threading.Thread(target=transcribe_job, daemon=True)
+    thread.start()
+
+    raw_entries = follow_cues(ctx.raw_path + ".part", ctx.raw_path, done)
+    corrected = _2_correct.stream_correction(ctx, raw_entries)
+    ok = run_stage("_3_translate.py", lambda c: _3_translate.translate_stream(c, corrected), ctx)
+    thread.join()
+
+    if not (ok and outcome.get('ok')):
+        # Never leave a partial translation behind that looks finished
+        if os.path.exists(ctx.translated_path):
+            os.remove(ctx.translated_path)
+        return False
+    return True
+
+def check_audio(ctx, failed):
+    """Fail a job that still needs transcribing but has no prepared audio"""
+    if ctx.input_file in failed or not needs_transcription(ctx):
+        return
+    if not ctx.stages.is_fresh("audio", ctx.audio_path, _0_prepare.audio_inputs(ctx)):
+        print(f"ERROR: Audio file not generated: {ctx.audio_path}")
+        failed.add(ctx.input_file)
+
+def prepare_in_background(jobs, prepare, failed):
+    """Run the prepare stage over `jobs` one after another in a thread.
+
+    Returns an Event per job that is set once the job is prepared, so the next
+    file is normalized (and Qwen consulted) while the current one streams.
+    """
+    prepared = {ctx.input_file: threading.Event() for ctx in jobs}
+
+    def work():
+        for ctx in jobs:
+            try:
+                run_phase([ctx], prepare, failed)
+                check_audio(ctx, failed)
+            finally:
+                prepared[ctx.input_file].set()
+
+    threading.Thread(target=work, daemon=True).start()
+    return prepared
+
+def process_stream(jobs, failed, transcribe, prepared=None):
+    """Overlap transcription with correction and translation, one file at a time"""
+    to_stream = [ctx for ctx in jobs if needs_translation(ctx)]
+    for ctx in to_stream:
+        if prepared:
+            prepared[ctx.input_file].wait()
+        if ctx.input_file in failed:
+            continue
+        print(f"Processing file: {ctx.input_file}")
+        sys.stdout.flush()
+        if needs_transcription(ctx):
+            print("--- RUNNING: streaming _1_whisper.py -> _2_correct.py -> _3_translate.py ---")
+            with telemetry.stage("stream", ctx) as span:
+                span["ok"] = ok = stream_file(ctx, transcribe)
+        else:
+            ok = (not needs_correction(ctx) or run_stage("_2_correct.py", lambda c: _2_correct.process_correction(c.input_file, c), ctx)) \
+                and run_stage("_3_translate.py", _3_translate.main, ctx)
+        ctx.cached("cache_index", CacheIndex).touch(ctx.cache_dir, [ctx.audio_path, ctx.raw_path, ctx.corrected_path])
+        if not ok:
+            print(f"ERROR: Processing failed for {ctx.input_file}")
+            failed.add(ctx.input_file)
+    for event in (prepared or {}).values():
+        event.wait()
+
+# Stage outputs of the cache layout before content hashing: core/cache/<stem>/*.srt
+LEGACY_AUDIO = "audio_16k_norm.wav"
+LEGACY_OUTPUTS = (
+    ("transcribe", "raw.srt", "raw_path", _1_whisper.transcription_inputs),
+    ("correct", "corrected.srt", "corrected_path", _2_correct.correction_inputs),
+    ("translate", "translated.srt", "translated_path", _3_translate.translation_inputs),
+)
+# Decoded length vs. container duration; encoder padding stays well below this
+LEGACY_DURATION_TOLERANCE = 0.25
+
+def legacy_entry_matches(ctx, legacy_dir):
+    """Whether the old entry was made from this input: the stem alone is shared by e.g. A/01.mp3 and B/01.mp3"""
+    cached = _0_prepare.wav_duration(os.path.join(legacy_dir, LEGACY_AUDIO))
+    source = _0_prepare.source_duration(ctx.input_file)
+    return cached is not None and source is not None and abs(cached - source) <= LEGACY_DURATION_TOLERANCE
+
+def adopt_legacy_cache(ctx):
+    """Take over the file's old stem-keyed cache entry, then remove it.
+
+    The entry is only adopted when its normalized audio is as long as the
+    input; anything else may belong to another file with the same name and is
+    discarded. The old WAV was made with today's loudnorm chain, so it is
+    recorded as the audio stage and the SRTs on top of it, and prepare does
+    not normalize again. When the final output already exists, it is kept
+    as before and the old entry is only removed.
+    """
+    legacy_dir = os.path.join(CACHE_ROOT, Path(ctx.input_file).stem)
+    if not os.path.isdir(legacy_dir) or os.path.exists(os.path.join(legacy_dir, "manifest.json")):
+        # Nothing there, or a content-hashed entry that happens to share the name
+        return
+    if file_valid(ctx.final_output):
+        print(f"Removed legacy cache: {legacy_dir}")
+    elif os.path.normcase(legacy_dir) == os.path.normcase(ctx.cache_dir):
+        return
+    elif ctx.stages.output_id("audio") or not legacy_entry_matches(ctx, legacy_dir):
+        print(f"Discarded legacy cache: {legacy_dir}")
     else:
+        inputs = _0_prepare.audio_inputs(ctx, "loudnorm")
+        _0_prepare.import_wav(os.path.join(legacy_dir, LEGACY_AUDIO), ctx.audio_path)
+        ctx.stages.record("audio", ctx.audio_path, inputs, output=digest(inputs))
+        for stage, name, attr, stage_inputs in LEGACY_OUTPUTS:
+            old_path = os.path.join(legacy_dir, name)
+            new_path = getattr(ctx, attr)
+            if not file_valid(old_path):
+                break
+            try:
+                cues = parse_srt(old_path)
+            except (OSError, ValueError):
+                break
+            write_cues(new_path, cues)
+            ctx.stages.record(stage, new_path, stage_inputs(ctx))
+        print(f"Adopted legacy cache: {legacy_dir}")
+    shutil.rmtree(legacy_dir, ignore_errors=True)
+
+def enforce_cache_budget(index, protect=()):
+    """Evict least recently used cache data over CACHE_BUDGET_MB and write the index"""
+    for path in index.evict(budget_bytes(), protect):
+        print(f"Cache evicted: {path}")
+    sys.stdout.flush()
+    index.save()
+
+def process_batch(files, whisper_in_process=False, stream=False, keep_server=False):
+    """Run the pipeline phase by phase so each LLM is loaded once per batch"""
+    shared = {}
+    jobs = [JobContext(f, shared) for f in files]
+    for ctx in jobs:
+        # Hashes the input if that has not happened yet; the app cleans these up
+        print(f"Cache directory: {ctx.cache_dir}")
+    # Stages get Qwen and Sakura from this pool (see server_pool.py)
+    servers = jobs[0].servers
+    try:
+        return run_pipeline(jobs, servers, whisper_in_process, stream)
+    finally:
+        servers.close(keep_alive=keep_server)
+
+def run_pipeline(jobs, servers, whisper_in_process, stream):
+    failed = set()
+    index = jobs[0].cached("cache_index", CacheIndex)
+    # Make room before the run adds its audio; this run's entries are kept
+    enforce_cache_budget(index, [ctx.cache_dir for ctx in jobs])
+
+    # Step 0: Prepare (Qwen is only loaded if context or terms are missing)
+    prompt_file_name = jobs[0].prompt_file_name
+    path_context = get_assets_context_path(prompt_file_name)
+    path_terms = get_assets_terms_path(prompt_file_name)
+    if file_valid(path_context) and file_valid(path_terms):
         print("Using existing context and terms from assets folder")
-        run_script("_0_prepare.py", [abs_input_path])
-    
-    path_raw = os.path.join(cache_dir, "raw.srt")
-    if not file_valid(path_raw):
-        audio_path = os.path.join(cache_dir, "audio_16k_norm.wav")
-        if not file_valid(audio_path):
-            print(f"ERROR: Audio file not generated: {audio_path}")
-            sys.exit(1)
-        run_script("_1_whisper.py", [abs_input_path])
+    prepare = stage_runner("_0_prepare.py", lambda ctx: _0_prepare.process_audio(ctx.input_file, ctx, needs_transcription(ctx)))
+
+    # Step 1: Transcribe (isolated in a worker process unless requested otherwise)
+    worker = None
+    if whisper_in_process:
+        transcribe = transcribe_in_process()
+    else:
+        worker = WhisperWorker()
+        transcribe = transcribe_with_worker(worker)
+
+    try:
+        if stream and servers.budget:
+            # Steps 0-3 overlapped: the next file is prepared while the current one streams
+            process_stream(jobs, failed, transcribe, prepare_in_background(jobs, prepare, failed))
+        else:
+            # One model at a time: finish with Qwen before Sakura is loaded
+            run_phase(jobs, prepare, failed)
+            for ctx in jobs:
+                check_audio(ctx, failed)
+            if any(ctx.input_file not in failed and needs_transcription(ctx) for ctx in jobs):
+                # Free the GPU for Whisper
+                servers.stop_idle()
+            if stream:
+                process_stream(jobs, failed, transcribe)
+            else:
+                run_phase(jobs, transcribe, failed, needs_transcription, lambda ctx: [ctx.audio_path])
+    finally:
+        if worker:
+            worker.stop()
 
     # Step 2: Correct
-    path_corrected = os.path.join(cache_dir, "corrected.srt")
-    if not file_valid(path_corrected):
-        run_script("_2_correct.py", [abs_input_path])
-
-    # Step 3: Translate
-    path_trans = os.path.join(cache_dir, "translated.srt")
-    if not file_valid(path_trans):
-        server = ServerManager(PORT)
-        sakura_path = get_sakura_model()
-        server.start(sakura_path)
-        try:
-            run_script("_3_translate.py", [abs_input_path])
-        finally:
-            server.stop()
+    run_phase(jobs, stage_runner("_2_correct.py", lambda ctx: _2_correct.process_correction(ctx.input_file, ctx)), failed, needs_correction,
+              lambda ctx: [ctx.raw_path])
+
+    # Step 3: Translate (Sakura stays resident in the pool for the whole batch)
+    run_phase(jobs, stage_runner("_3_translate.py", _3_translate.main), failed, needs_translation, lambda ctx: [ctx.corrected_path])
 
     # Step 4: Output
-    run_script("_4_output.py", [abs_input_path])
-    print("All Done.")
+    run_phase(jobs, stage_runner("_4_output.py", _4_output.main), failed, reads=lambda ctx: [ctx.translated_path])
+    enforce_cache_budget(index)
+    return failed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AISMR subtitle pipeline")
+    parser.add_argument("inputs", nargs="*", default=[DEFAULT_INPUT], help="media files or directories")
+    parser.add_argument("--whisper-in-process", action="store_true",
+                        help="load Whisper inside this process instead of an isolated worker")
+    parser.add_argument("--whisper-workers", type=int, default=int(os.environ.get("WHISPER_CHUNK_WORKERS", 0)),
+                        help="split long audio into chunks decoded by this many CPU Whisper processes (0 = off)")
+    parser.add_argument("--whisper-profile", choices=list(_1_whisper.PROFILES), default=os.environ.get("WHISPER_PROFILE", _1_whisper.DEFAULT_PROFILE),
+                        help="Whisper decode profile: batched fast/balanced, sequential beam-5 accurate, or cpu")
+    parser.add_argument("--stream", action="store_true",
+                        help="correct and translate segments while Whisper is still decoding the file")
+    parser.add_argument("--normalize", choices=_0_prepare.NORMALIZE_ENGINES, default=os.environ.get("NORMALIZE_ENGINE", "loudnorm"),
+                        help="audio normalization engine: ffmpeg loudnorm, or 16 kHz compand + NumPy gain/limiter")
+    parser.add_argument("--cache-budget-mb", type=float, default=float(os.environ.get("CACHE_BUDGET_MB", 0)),
+                        help="evict least recently used cache data above this size (0 = unlimited)")
+    parser.add_argument("--parallel", type=int, default=int(os.environ.get("LLM_PARALLEL", 1)),
+                        help="number of translation requests kept in flight on the Sakura server")
+    parser.add_argument("--keep-server", action="store_true", default=os.environ.get("LLM_KEEP_ALIVE", "") not in ("", "0"),
+                        help="leave the resident LLM servers running at exit so the next run reuses the loaded models")
+    parser.add_argument("--llm-budget-mb", type=float, default=float(os.environ.get("LLM_MEMORY_BUDGET_MB", 0)),
+                        help="memory the resident LLM servers may use together; 0 = one model at a time")
+    parser.add_argument("--profile", action="store_true", default=os.environ.get("AISMR_PROFILE", "") not in ("", "0"),
+                        help="run every stage under cProfile, stats go to profile_<stage>.prof in the cache entry")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    args.parallel = max(1, args.parallel)
+    os.environ["LLM_PARALLEL"] = str(args.parallel)
+    os.environ["WHISPER_CHUNK_WORKERS"] = str(max(0, args.whisper_workers))
+    os.environ["WHISPER_PROFILE"] = args.whisper_profile
+    os.environ["NORMALIZE_ENGINE"] = args.normalize
+    os.environ["CACHE_BUDGET_MB"] = str(max(0, args.cache_budget_mb))
+    os.environ["AISMR_PROFILE"] = "1" if args.profile else "0"
+    os.environ["LLM_MEMORY_BUDGET_MB"] = str(max(0, args.llm_budget_mb))
+
+    for target in args.inputs:
+        if not os.path.exists(target):
+            print(f"ERROR: Input file not found: {target}")
+            sys.exit(1)
+
+    input_files = collect_input_files(args.inputs)
+    if not input_files:
+        print("ERROR: No media files found.")
+        sys.exit(1)
+
+    pending = []
+    for abs_input_path in input_files:
+        print(f"Processing file: {abs_input_path}")
+        ctx = JobContext(abs_input_path)
+        adopt_legacy_cache(ctx)
+        if is_up_to_date(ctx):
+            print(f"Final output already exists: {ctx.final_output}")
+            print("Skipping all processing.")
+            continue
+        pending.append(abs_input_path)
+    sys.stdout.flush()
+
+    if not pending:
+        sys.exit(0)
+
+    telemetry.emit("run_start", files=len(pending), stream=args.stream, parallel=args.parallel,
+                   whisper_workers=max(0, args.whisper_workers), whisper_profile=args.whisper_profile, normalize=args.normalize)
+    started = time.perf_counter()
+    failed = process_batch(pending, args.whisper_in_process, args.stream, args.keep_server)
+    telemetry.emit("run_end", files=len(pending), failed=len(failed), wall_s=round(time.perf_counter() - started, 3))
+    exit_code = 0
+    if failed:
+        print(f"ERROR: {len(failed)} of {len(pending)} files failed.")
+        exit_code = 1
+    else:
+        print("All Done.")
+    sys.stdout.flush()
+
+    if args.whisper_in_process:
+        # Same as _1_whisper.py: skip interpreter teardown once the CUDA model was loaded
+        os._exit(exit_code)
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
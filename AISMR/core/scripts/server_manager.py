@@ -1,29 +1,131 @@
 import os
 import sys
+import json
+import glob
+import socket
 import subprocess
 import time
 import requests
 import psutil
-from utils import BIN_DIR
+from utils import BIN_DIR, CACHE_ROOT, ensure_directory, replace_file
+
+# Servers started by an earlier run and left running (or orphaned by a crash),
+# one file per requested port in STATE_DIR
+STATE_DIR = CACHE_ROOT
+STATE_FILE = "llama_server_{}.json"
+STARTUP_TIMEOUT = float(os.environ.get("LLM_STARTUP_TIMEOUT", 120))
+POLL_MIN = 0.05
+POLL_MAX = 0.2
+
+def default_server_exe():
+    override = os.environ.get("LLAMA_SERVER_BIN")
+    if override:
+        return override
+    return os.path.join(BIN_DIR, "llama", "llama-server.exe" if os.name == "nt" else "llama-server")
+
+def recorded_servers(state_dir=STATE_DIR):
+    """State of the servers earlier runs left behind: [{pid, port, model, parallel, ...}]"""
+    states = []
+    for path in glob.glob(os.path.join(state_dir, STATE_FILE.format("*"))):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return states
+
+def same_path(a, b):
+    return bool(a and b) and os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
+
+def port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        if os.name != "nt":
+            # Like llama-server itself; a port in TIME_WAIT from our last server is free
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(("127.0.0.1", port))
+            return True
+        except OSError:
+            return False
 
 class ServerManager:
-    def __init__(self, port=8080):
+    """One llama-server on one port.
+
+    A server that already serves the requested model with the requested number
+    of slots is reused instead of restarted. The only process ever terminated
+    is a server this manager started, or one an earlier run recorded in its
+    STATE_FILE; anything else on the port is left alone and a free port is used.
+    """
+
+    def __init__(self, port=8080, state_dir=STATE_DIR):
         self.port = port
-        self.process = None
-        self.server_exe = os.path.join(BIN_DIR, "llama", "llama-server.exe")
+        self.state_dir = state_dir
+        self.state_file = os.path.join(state_dir, STATE_FILE.format(port))
+        self.process = None     # psutil.Process of the server we own
+        self.popen = None
+        self.model_path = None
+        self.parallel = None
+        self.server_exe = default_server_exe()
 
-    def _kill_existing_servers(self):
-        for proc in psutil.process_iter(['pid', 'name']):
-            try:
-                if proc.info['name'] and 'llama-server.exe' in proc.info['name'].lower():
-                    proc.kill()
-            except:
-                pass
-        time.sleep(1)
+    def props(self):
+        """/props of the server on our port (model_path, total_slots, ...), or None"""
+        try:
+            res = requests.get(f"http://127.0.0.1:{self.port}/props", timeout=0.5)
+            if res.status_code == 200:
+                return res.json()
+        except (requests.RequestException, ValueError):
+            pass
+        return None
+
+    def _recorded(self):
+        """Our server from an earlier run, if it is still the same process"""
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            proc = psutil.Process(state['pid'])
+            if abs(proc.create_time() - state['create_time']) < 1:
+                self.port = state['port']
+                return proc
+        except (OSError, ValueError, KeyError, psutil.Error):
+            pass
+        self._forget()
+        return None
+
+    def _remember(self):
+        ensure_directory(os.path.dirname(self.state_file))
+        tmp = f"{self.state_file}.{os.getpid()}.part"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'pid': self.process.pid, 'create_time': self.process.create_time(), 'port': self.port,
+                       'model': self.model_path, 'parallel': self.parallel}, f)
+        replace_file(tmp, self.state_file)
+
+    def _forget(self):
+        try:
+            os.remove(self.state_file)
+        except OSError:
+            pass
+
+    def _serves(self, model_path, parallel):
+        props = self.props()
+        return props is not None and same_path(props.get('model_path'), model_path) and props.get('total_slots', 1) == parallel
+
+    def start(self, model_path, parallel=1):
+        if self.process is None:
+            self.process = self._recorded()
+        elif self.model_path == model_path and self.parallel == parallel and self.process.is_running():
+            return
+
+        if self._serves(model_path, parallel):
+            print(f"Reusing Engine: {os.path.basename(model_path)} on port {self.port} ({parallel} slots)", flush=True)
+            self.model_path, self.parallel = model_path, parallel
+            return
+
+        self._terminate()
+        while not port_free(self.port):
+            # Someone else's server (or anything else) holds the port
+            self.port += 1
+        self.state_file = os.path.join(self.state_dir, STATE_FILE.format(self.port))
 
-    def start(self, model_path):
-        self._kill_existing_servers()
-        
         if not os.path.exists(self.server_exe):
             print(f"Error: Server binary not found at {self.server_exe}")
             sys.exit(1)
@@ -33,48 +135,72 @@ class ServerManager:
             "-m", model_path,
             "--port", str(self.port),
             "-ngl", "99",
-            "-c", "8192"
+            # Context is split across slots, keep 8192 tokens per slot
+            "-c", str(8192 * parallel),
+            "-np", str(parallel)
         ]
 
-        print(f"Starting Engine: {os.path.basename(model_path)} on port {self.port}...")
-        
-        startupinfo = subprocess.STARTUPINFO()
-        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        creationflags = subprocess.CREATE_NO_WINDOW
+        print(f"Starting Engine: {os.path.basename(model_path)} on port {self.port} ({parallel} slots)...")
 
-        self.process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            startupinfo=startupinfo,
-            creationflags=creationflags
-        )
+        kwargs = {}
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            kwargs = dict(startupinfo=startupinfo, creationflags=subprocess.CREATE_NO_WINDOW)
 
+        self.popen = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **kwargs)
+        self.process = psutil.Process(self.popen.pid)
+        self.model_path, self.parallel = model_path, parallel
+        self._remember()
         self._wait_for_healthy()
 
     def _wait_for_healthy(self):
+        """Poll /health with a short backoff until it reports "ok" (503 while the model loads)"""
         url = f"http://127.0.0.1:{self.port}/health"
         print("Waiting for engine to load...", flush=True)
-        for i in range(60): 
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        delay = POLL_MIN
+        while time.monotonic() < deadline and self.popen.poll() is None:
             try:
                 res = requests.get(url, timeout=1)
-                if res.status_code == 200:
-                    status = res.json().get('status', '')
-                    if status == 'ok' or status == 'loading model':
-                        print("Engine Ready.", flush=True)
-                        time.sleep(1)
-                        return
-            except:
+                # The port may have been taken by another server in the meantime
+                if res.status_code == 200 and res.json().get('status') == 'ok' and self._serves(self.model_path, self.parallel):
+                    print("Engine Ready.", flush=True)
+                    return
+            except (requests.RequestException, ValueError):
                 pass
-            time.sleep(1)
-        
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+
         print("\nServer failed to start.")
-        self.stop()
+        self._terminate()
         sys.exit(1)
 
-    def stop(self):
-        if self.process:
-            print("Stopping Engine...")
+    def _terminate(self):
+        if self.process is None:
+            return
+        try:
+            self.process.terminate()
+            self.process.wait(timeout=5)
+        except psutil.TimeoutExpired:
             self.process.kill()
-            self.process = None
-        self._kill_existing_servers()
\ No newline at end of file
+        except psutil.Error:
+            pass
+        if self.popen:
+            self.popen.poll()
+        self.process = self.popen = None
+        self.model_path = self.parallel = None
+        self._forget()
+
+    def stop(self, keep_alive=False):
+        """Stop our server; with `keep_alive` leave it running for the next run to reuse"""
+        if self.process is None:
+            self.model_path = self.parallel = None
+            return
+        if keep_alive:
+            print("Leaving Engine running for the next run", flush=True)
+            self.process = self.popen = None
+            self.model_path = self.parallel = None
+            return
+        print("Stopping Engine...")
+        self._terminate()
@@ -0,0 +1,153 @@
+"""llama-servers for several models at once, each on its own port.
+
+Stages ask for a model (`ctx.llm(model_path)`) instead of a port. A model
+stays loaded after use while the estimated memory of everything resident fits
+in LLM_MEMORY_BUDGET_MB; to make room, idle servers are stopped least recently
+used first, and a request waits while the servers in the way are still in
+use. Without a budget one model is resident at a time, as before.
+"""
+import atexit
+import os
+import threading
+import time
+import psutil
+from server_manager import STATE_DIR, ServerManager, recorded_servers, same_path
+
+# KV cache of one 8192-token slot of a 4B model, on top of the weights
+SLOT_BYTES = 1 << 30
+
+def budget_bytes():
+    """Configured budget from LLM_MEMORY_BUDGET_MB; 0 means one model at a time"""
+    try:
+        return max(0, int(float(os.environ.get("LLM_MEMORY_BUDGET_MB", 0)) * 1024 * 1024))
+    except ValueError:
+        return 0
+
+def estimate_bytes(model_path, parallel):
+    try:
+        size = os.path.getsize(model_path)
+    except OSError:
+        size = 0
+    return size + parallel * SLOT_BYTES
+
+class _Resident:
+    __slots__ = ('server', 'need', 'refs', 'last_used', 'ready', 'failed')
+
+    def __init__(self, server, need):
+        self.server = server
+        self.need = need
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.ready = threading.Event()
+        self.failed = False
+
+class ServerPool:
+    def __init__(self, budget=None, base_port=None, state_dir=STATE_DIR):
+        self.budget = budget_bytes() if budget is None else budget
+        self.base_port = base_port or int(os.environ.get("LLM_PORT", 8080))
+        self.state_dir = state_dir
+        self.resident = {}   # (model_path, parallel) -> _Resident
+        self.cond = threading.Condition()
+        self.closed = False
+        atexit.register(self.close)
+
+    def _fits(self, need):
+        if not self.resident:
+            return True
+        if not self.budget:
+            return False
+        return sum(r.need for r in self.resident.values()) + need <= self.budget
+
+    def _evict_for(self, need):
+        """Stop idle servers, least recently used first, until `need` fits"""
+        idle = sorted((r.last_used, key) for key, r in self.resident.items() if r.refs == 0 and r.ready.is_set())
+        for _, key in idle:
+            if self._fits(need):
+                break
+            self.resident.pop(key).server.stop()
+
+    def _port_for(self, model_path, parallel, need):
+        used = {r.server.port for r in self.resident.values()}
+        others = []
+        for state in recorded_servers(self.state_dir):
+            if not psutil.pid_exists(state.get('pid', 0)):
+                continue
+            # A server an earlier run left with this model is picked up again
+            if same_path(state.get('model'), model_path) and state.get('parallel') == parallel and state.get('port') not in used:
+                return state['port']
+            others.append(state)
+        # Servers left with other models keep their port while the budget has room for
+        # them too, so a later request for their model can pick them up
+        room = self.budget - sum(r.need for r in self.resident.values()) - need
+        for state in others:
+            other = estimate_bytes(state.get('model') or "", state.get('parallel') or 1)
+            if other <= room:
+                used.add(state.get('port'))
+                room -= other
+        port = self.base_port
+        while port in used:
+            port += 1
+        return port
+
+    def acquire(self, model_path, parallel=1):
+        """A started ServerManager serving `model_path`; hand it back with release()"""
+        key = (os.path.normcase(os.path.abspath(model_path)), parallel)
+        need = estimate_bytes(model_path, parallel)
+        starter = False
+        with self.cond:
+            while True:
+                entry = self.resident.get(key)
+                if entry is None:
+                    self._evict_for(need)
+                    if self._fits(need):
+                        entry = self.resident[key] = _Resident(ServerManager(self._port_for(model_path, parallel, need), self.state_dir), need)
+                        starter = True
+                if entry is not None:
+                    entry.refs += 1
+                    entry.last_used = time.monotonic()
+                    break
+                # Everything in the way is still in use
+                self.cond.wait()
+
+        if starter:
+            try:
+                entry.server.start(model_path, parallel)
+            except BaseException:
+                with self.cond:
+                    self.resident.pop(key, None)
+                    self.cond.notify_all()
+                entry.failed = True
+                entry.ready.set()
+                raise
+            entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.failed:
+                raise RuntimeError(f"Server for {os.path.basename(model_path)} failed to start")
+        return entry.server
+
+    def release(self, server):
+        with self.cond:
+            for r in self.resident.values():
+                if r.server is server:
+                    r.refs -= 1
+                    r.last_used = time.monotonic()
+            self.cond.notify_all()
+
+    def stop_idle(self):
+        """Stop every server that is not in use (e.g. to free the GPU for Whisper)"""
+        with self.cond:
+            for key in [k for k, r in self.resident.items() if r.refs == 0 and r.ready.is_set()]:
+                self.resident.pop(key).server.stop()
+            self.cond.notify_all()
+
+    def close(self, keep_alive=False):
+        """Stop all servers; with `keep_alive` leave them running for the next run"""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            for r in self.resident.values():
+                r.server.stop(keep_alive=keep_alive)
+            self.resident.clear()
+            self.cond.notify_all()
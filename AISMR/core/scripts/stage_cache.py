@@ -0,0 +1,69 @@
+"""Per-stage manifests for one cache entry.
+
+Every stage records what it consumed in `<cache>/manifest.json` next to its
+output: the output id of the upstream stage, a digest of its config and of the
+dictionaries it used. A stage is fresh while its output is still there and the
+inputs it would consume now match the recorded ones, so after e.g. a dictionary
+edit only the stages that actually read the dictionary run again. An upstream
+stage that re-runs but produces an identical file keeps the old output id and
+does not invalidate anything below it.
+"""
+import hashlib
+import json
+import os
+import threading
+from utils import file_sha1, replace_file
+
+MANIFEST_FILE = "manifest.json"
+
+def digest(value):
+    """Stable sha1 of any JSON-serializable value"""
+    data = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+class StageCache:
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, MANIFEST_FILE)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def exists(self):
+        return bool(self.load())
+
+    def output_id(self, stage):
+        """Id of the last recorded output of `stage`, or None"""
+        entry = self.load().get(stage)
+        return entry['output'] if entry else None
+
+    def changed_inputs(self, stage, output_path, inputs):
+        """Names of the inputs that differ from the manifest; ["output"] when the output is missing"""
+        entry = self.load().get(stage)
+        if not entry or not os.path.exists(output_path) or os.path.getsize(output_path) != entry.get('size'):
+            return ["output"]
+        recorded = entry.get('inputs', {})
+        return [k for k in set(recorded) | set(inputs) if recorded.get(k) != inputs.get(k)]
+
+    def is_fresh(self, stage, output_path, inputs):
+        return not self.changed_inputs(stage, output_path, inputs)
+
+    def record(self, stage, output_path, inputs, output=None):
+        """Store the inputs a stage just consumed.
+
+        The output id defaults to the sha1 of the output file; pass `output` for
+        large artifacts that are identified by their inputs instead.
+        """
+        manifest = self.load()
+        manifest[stage] = {
+            'inputs': inputs,
+            'output': output or file_sha1(output_path),
+            'size': os.path.getsize(output_path),
+        }
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        replace_file(tmp, self.path)
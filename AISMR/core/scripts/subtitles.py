@@ -0,0 +1,160 @@
+"""Subtitle cues shared by every stage, and the files they are kept in.
+
+Between stages cues live in JSON-lines files, one `[start_ms, end_ms, "text"]`
+array per line. Times are integer milliseconds throughout, so nothing is
+formatted and parsed again on the way from Whisper to the final output, and a
+file that is still being appended to can be followed line by line. SRT and
+LRC only appear at the edges: the final export and the import of old caches.
+"""
+import codecs
+import json
+import os
+import time
+from array import array
+
+class Cue:
+    __slots__ = ('start', 'end', 'text')
+
+    def __init__(self, start, end, text):
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return f"Cue({self.start}, {self.end}, {self.text!r})"
+
+class Track:
+    """Columnar cue storage: start/end times in int64 arrays and a list of texts"""
+
+    def __init__(self, cues=()):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.texts = []
+        for cue in cues:
+            self.append(cue)
+
+    def append(self, cue):
+        self.starts.append(cue.start)
+        self.ends.append(cue.end)
+        self.texts.append(cue.text)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __iter__(self):
+        for start, end, text in zip(self.starts, self.ends, self.texts):
+            yield Cue(start, end, text)
+
+def to_ms(seconds):
+    return int(round(seconds * 1000))
+
+def encode(cue):
+    return json.dumps([cue.start, cue.end, cue.text], ensure_ascii=False) + "\n"
+
+def decode(line):
+    start, end, text = json.loads(line)
+    return Cue(start, end, text)
+
+def read_cues(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [decode(line) for line in f if line.strip()]
+
+def read_track(path):
+    return Track(read_cues(path))
+
+def write_cues(path, cues):
+    with open(path, 'w', encoding='utf-8') as f:
+        for cue in cues:
+            f.write(encode(cue))
+
+class CueWriter:
+    """Appends cues to a file, flushing each one so a reader can follow along"""
+
+    def __init__(self, path, append=False):
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, cue):
+        self.file.write(encode(cue))
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def follow_cues(part_path, final_path, done, poll_interval=0.5):
+    """Yield cues of a file that is still being written to `part_path`.
+
+    Ends once `done` is set and everything has been read; raises if the
+    writer never renamed the file to `final_path`. `final_path` is only read
+    after `done`, so a stale file from an earlier run is never followed.
+    """
+    offset = 0
+    pending = ""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        finished = done.is_set()
+        data = b""
+        for path in (part_path, final_path) if finished else (part_path,):
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+                break
+            except OSError:
+                continue
+        offset += len(data)
+        pending += decoder.decode(data)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield decode(line)
+        if finished and not data:
+            break
+        if not data:
+            time.sleep(poll_interval)
+
+    if not os.path.exists(final_path):
+        raise RuntimeError(f"Writer did not complete: {final_path}")
+
+def format_srt_time(ms):
+    s, ms = divmod(ms, 1000)
+    return f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d},{ms:03d}"
+
+def parse_srt_time(ts):
+    h, m, s = ts.strip().split(':')
+    s, ms = s.split(',')
+    return ((int(h) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
+
+def format_lrc_time(ms):
+    cs = (ms + 5) // 10
+    return f"{cs // 6000:02d}:{cs % 6000 // 100:02d}.{cs % 100:02d}"
+
+def parse_srt(path):
+    """Cues of an SRT file; multi-line texts are joined with spaces"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    cues = []
+    for block in content.strip().split('\n\n'):
+        lines = block.split('\n')
+        if len(lines) >= 3:
+            start, end = lines[1].split(' --> ')
+            cues.append(Cue(parse_srt_time(start), parse_srt_time(end), " ".join(lines[2:])))
+    return cues
+
+def export_srt(path, cues):
+    with open(path, 'w', encoding='utf-8') as f:
+        for i, cue in enumerate(cues, 1):
+            f.write(f"{i}\n{format_srt_time(cue.start)} --> {format_srt_time(cue.end)}\n{cue.text}\n\n")
+
+def export_lrc(path, cues):
+    with open(path, 'w', encoding='utf-8') as f:
+        for cue in cues:
+            f.write(f"[{format_lrc_time(cue.start)}]{cue.text}\n")
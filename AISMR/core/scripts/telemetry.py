@@ -0,0 +1,100 @@
+"""Machine-readable pipeline events.
+
+Each event is one JSON object. It is printed as an `EVENT: {...}` line for the
+app and appended to `<cache>/events.jsonl` of the job it belongs to, so the
+timings of a file survive the run:
+
+    {"event": "stage_end", "time": 1718000000.0, "file": "track1.wav",
+     "stage": "_2_correct.py", "ok": true, "wall_s": 1.52, "cpu_s": 1.47}
+
+With AISMR_PROFILE set, every stage also runs under cProfile and the stats are
+written to `<cache>/profile_<stage>.prof` (`python -m pstats` to read them).
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+EVENT_PREFIX = "EVENT: "
+EVENTS_FILE = "events.jsonl"
+
+_lock = threading.Lock()
+_profiling = threading.Lock()
+
+def emit(event, ctx=None, **fields):
+    record = {"event": event, "time": round(time.time(), 3)}
+    if ctx is not None:
+        record["file"] = os.path.basename(ctx.input_file)
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False)
+    with _lock:
+        print(EVENT_PREFIX + line, flush=True)
+        if ctx is not None and os.path.isdir(ctx.cache_dir):
+            try:
+                with open(os.path.join(ctx.cache_dir, EVENTS_FILE), 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+            except OSError:
+                pass
+
+def profiling_enabled():
+    return os.environ.get("AISMR_PROFILE", "") not in ("", "0")
+
+@contextmanager
+def profile(name, ctx):
+    """cProfile the block into the cache entry when AISMR_PROFILE is set"""
+    # One profiler at a time per process: a stage that starts while another is
+    # being profiled (nested, or alongside it in streaming mode) is not profiled itself
+    profiler = None
+    if profiling_enabled() and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            _profiling.release()
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiling.release()
+            path = os.path.join(ctx.cache_dir, f"profile_{os.path.splitext(name)[0].strip('_')}.prof")
+            try:
+                profiler.dump_stats(path)
+                emit("profile", ctx, stage=name, path=path)
+            except OSError:
+                pass
+
+@contextmanager
+def stage(name, ctx):
+    """Emit stage_start / stage_end around a block with its wall and CPU time.
+
+    Yields a dict for extra stage_end fields; set "ok" to False on failure.
+    CPU time is that of this process, so it includes stages running alongside
+    in streaming mode and excludes worker processes (they report their own).
+    """
+    emit("stage_start", ctx, stage=name)
+    fields = {"ok": True}
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        with profile(name, ctx):
+            yield fields
+    except BaseException:
+        fields["ok"] = False
+        raise
+    finally:
+        emit("stage_end", ctx, stage=name, **fields,
+             wall_s=round(time.perf_counter() - wall, 3), cpu_s=round(time.process_time() - cpu, 3))
+
+def llm_usage(ctx, name, llm):
+    """Token counts and throughput of every request `llm` made, from llama-server's timings"""
+    s = llm.usage()
+    if not s["requests"]:
+        return
+    emit("llm", ctx, stage=name, requests=s["requests"],
+         prompt_tokens=s["prompt_tokens"], cached_tokens=s["cached_tokens"], generated_tokens=s["generated_tokens"],
+         prompt_tps=round(s["prompt_tokens"] / s["prompt_ms"] * 1000, 1) if s["prompt_ms"] else None,
+         generation_tps=round(s["generated_tokens"] / s["generated_ms"] * 1000, 1) if s["generated_ms"] else None)
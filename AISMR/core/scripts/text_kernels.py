@@ -0,0 +1,153 @@
+"""Repetition folding for Whisper output without regex backtracking.
+
+fold_repetitions(text) gives the same result as
+
+    re.sub(r'(.+?)\\1{2,}', r'\\1...', text)
+
+which backtracks over every start position and every candidate length and goes
+quadratic (or worse) on long hallucinated loops. Here the repetitions are found
+period by period: a run of period L that is at least 3L long must contain a
+sample position q = jL with text[q] == text[q+L], and from there the run is
+extended in both directions with rolling-hash comparisons. Each position is then
+assigned the smallest period that starts a 3-fold repetition at it, which is
+exactly the group the lazy regex would pick. Runs are found in O(n log^2 n).
+
+The kernel only pays off on long lines. Measured with `benchmark.py kernels`
+(CPython, seconds, regex / kernel):
+
+    chars   random         near-loop      real loop
+    200     0.001 / 0.001  0.0004 / 0.004  0.0000 / 0.0003
+    1000    0.028 / 0.008  0.010  / 0.017  0.0000 / 0.001
+    4000    0.33  / 0.030  0.16   / 0.12   0.0000 / 0.004
+    16000   6.6   / 0.16   2.7    / 0.60   0.0002 / 0.027
+
+so lines up to REGEX_MAX_CHARS (all ordinary Whisper lines) still go through
+the regex, and the kernel takes over where the regex turns quadratic.
+
+Hashes are taken modulo 2^61-1 with a random base, so a collision (and with it
+a result different from the regex) has a probability far below 2^-40 on the
+line lengths Whisper produces.
+"""
+import random
+import re
+
+# Up to here the regex is faster: it only goes quadratic on long lines
+REGEX_MAX_CHARS = 2000
+_REPEAT = re.compile(r'(.+?)\1{2,}')
+_MOD = (1 << 61) - 1
+_BASE = random.randrange(1 << 20, _MOD - 1)
+
+class _Hasher:
+    def __init__(self, text):
+        n = len(text)
+        prefix = [0] * (n + 1)
+        power = [1] * (n + 1)
+        h = 0
+        for i, ch in enumerate(text):
+            h = (h * _BASE + ord(ch)) % _MOD
+            prefix[i + 1] = h
+            power[i + 1] = power[i] * _BASE % _MOD
+        self.prefix = prefix
+        self.power = power
+        self.n = n
+
+    def get(self, start, end):
+        return (self.prefix[end] - self.prefix[start] * self.power[end - start]) % _MOD
+
+    def common_prefix(self, a, b, limit):
+        """Length of the longest common prefix of text[a:] and text[b:], at most `limit`"""
+        lo, hi = 0, limit
+        step = 1
+        # Gallop first: most extensions are short
+        while step < hi and self.get(a, a + step) == self.get(b, b + step):
+            lo = step
+            step *= 2
+        hi = min(hi, step)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.get(a, a + mid) == self.get(b, b + mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def common_suffix(self, a, b, limit):
+        """Length of the longest common suffix of text[:a] and text[:b], at most `limit`"""
+        lo, hi = 0, limit
+        step = 1
+        while step < hi and self.get(a - step, a) == self.get(b - step, b):
+            lo = step
+            step *= 2
+        hi = min(hi, step)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.get(a - mid, a) == self.get(b - mid, b):
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+def smallest_periods(text):
+    """For each start i, the smallest L with text[i:i+3L] of period L, or 0"""
+    n = len(text)
+    best = [0] * n
+    if n < 3:
+        return best
+    hasher = _Hasher(text)
+    # next_free[i]: smallest position >= i without a period yet (union-find with path halving)
+    next_free = list(range(n + 1))
+
+    def find(i):
+        while next_free[i] != i:
+            next_free[i] = next_free[next_free[i]]
+            i = next_free[i]
+        return i
+
+    for L in range(1, n // 3 + 1):
+        if find(0) > n - 3 * L:
+            # No free position can start a 3-fold run of this or any longer period
+            break
+        q = 0
+        while q + L < n:
+            if text[q] != text[q + L]:
+                q += L
+                continue
+            fwd = hasher.common_prefix(q, q + L, n - q - L)
+            back = hasher.common_suffix(q, q + L, q)
+            start, end = q - back, q + L + fwd
+            if end - start >= 3 * L:
+                i = find(start)
+                last = end - 3 * L
+                while i <= last:
+                    best[i] = L
+                    next_free[i] = i + 1
+                    i = find(i + 1)
+            # Every later sample inside this run finds the same run
+            q += (fwd // L + 1) * L
+    return best
+
+def fold_line(line):
+    """The kernel on one line (no newlines)"""
+    best = smallest_periods(line)
+    out = []
+    i = 0
+    n = len(line)
+    while i < n:
+        L = best[i]
+        if not L:
+            out.append(line[i])
+            i += 1
+            continue
+        unit = line[i:i + L]
+        j = i + L
+        while line.startswith(unit, j):
+            j += L
+        out.append(unit)
+        out.append("...")
+        i = j
+    return "".join(out)
+
+def fold_repetitions(text):
+    # `.` does not match a newline, so no repetition spans lines
+    return "\n".join(fold_line(line) if len(line) > REGEX_MAX_CHARS else _REPEAT.sub(r'\1...', line)
+                     for line in text.split("\n"))
@@ -0,0 +1,90 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import unicodedata
+from utils import CACHE_ROOT, ensure_directory
+
+TM_PATH = os.path.join(CACHE_ROOT, "translation_memory.db")
+TM_MAX_ENTRIES = int(os.environ.get("TM_MAX_ENTRIES", 200000))
+LOOKUP_CHUNK = 500
+
+def normalize_source(text):
+    """Key used for a source line: NFKC-folded with whitespace collapsed"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def context_fingerprint(model_name, summary, style, dict_data):
+    """Fingerprint of everything besides the line itself that shapes a translation.
+
+    The whole dictionary is hashed instead of the per-file filtered glossary so
+    that every track of a work shares the same memory.
+    """
+    h = hashlib.sha1()
+    for part in (model_name, summary, style):
+        h.update((part or "").encode("utf-8") + b"\0")
+    for item in dict_data:
+        if item.get('trans') and item.get('type') != 'noise':
+            h.update(f"{item.get('term')}->{item.get('trans')}".encode("utf-8") + b"\0")
+    return h.hexdigest()[:16]
+
+class TranslationMemory:
+    """SQLite store of translated lines keyed by (fingerprint, normalized source).
+
+    Least recently used rows are evicted once the table grows past `max_entries`.
+    """
+
+    def __init__(self, fingerprint, path=TM_PATH, max_entries=TM_MAX_ENTRIES):
+        ensure_directory(os.path.dirname(path))
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "fingerprint TEXT NOT NULL, source TEXT NOT NULL, target TEXT NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (fingerprint, source))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS memory_last_used ON memory (last_used)")
+        self.conn.commit()
+
+    def lookup(self, sources):
+        """Return {source: target} for the sources already in memory"""
+        sources = list(sources)
+        found = {}
+        for i in range(0, len(sources), LOOKUP_CHUNK):
+            chunk = sources[i:i+LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT source, target FROM memory WHERE fingerprint = ? AND source IN ({marks})",
+                [self.fingerprint] + chunk
+            ).fetchall()
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE memory SET last_used = ? WHERE fingerprint = ? AND source = ?",
+                [(now, self.fingerprint, s) for s in found]
+            )
+        return found
+
+    def store(self, pairs):
+        """Insert (source, target) pairs and evict the oldest rows over the size bound"""
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO memory (fingerprint, source, target, last_used) VALUES (?, ?, ?, ?)",
+            [(self.fingerprint, s, t, now) for s, t in pairs]
+        )
+        count = self.conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM memory WHERE rowid IN (SELECT rowid FROM memory ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
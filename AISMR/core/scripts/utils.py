@@ -3,7 +3,13 @@ import sys
 import json
 import requests
 import time
+import asyncio
+import glob
+import hashlib
+import threading
+from contextlib import contextmanager
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -18,6 +24,10 @@ BIN_DIR = os.path.join(PROJECT_ROOT, "bin")
 QWEN_URL = "https://huggingface.co/unsloth/Qwen3-4B-Instruct-2507-GGUF/resolve/main/Qwen3-4B-Instruct-2507-Q6_K.gguf?download=true"
 SAKURA_URL = "https://huggingface.co/SakuraLLM/GalTransl-v4-4B-2512/resolve/main/GalTransl-v4-4B-2512.gguf?download=true"
 
+AUDIO_EXTS = ['.mp3', '.wav', '.flac', '.m4a', '.aac']
+VIDEO_EXTS = ['.mp4', '.mkv', '.avi', '.mov']
+MEDIA_EXTS = AUDIO_EXTS + VIDEO_EXTS
+
 MODELS_CONFIG = [
     {"url": QWEN_URL, "path": os.path.join(LLM_DIR, "Qwen3-4B-Instruct-2507-Q6_K.gguf"), "name": "Context AI (Qwen)"},
     {"url": SAKURA_URL, "path": os.path.join(LLM_DIR, "GalTransl-v4-4B-2512.gguf"), "name": "Translator AI (Sakura)"}
@@ -27,11 +37,80 @@ def ensure_directory(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def get_cache_dir(input_file):
-    # Use Path for better Unicode handling
-    input_path = Path(input_file)
-    base_name = input_path.stem
-    cache_dir = os.path.join(CACHE_ROOT, base_name)
+def replace_file(src, dst, retries=5):
+    """os.replace that retries while another process briefly has the file open (Windows)"""
+    for attempt in range(retries):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.2)
+
+HASH_INDEX = os.path.join(CACHE_ROOT, "hashes.json")
+HASH_CHUNK = 1 << 20
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_hash_index():
+    try:
+        with open(HASH_INDEX, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def stat_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def memoized_hash(input_file):
+    """The hash content_hash() recorded for the file as it is now, or None (nothing is read)"""
+    path = os.path.abspath(input_file)
+    entry = load_hash_index().get(path)
+    try:
+        if entry and entry[:2] == stat_key(path):
+            return entry[2]
+    except OSError:
+        pass
+    return None
+
+def content_hash(input_file):
+    """sha1 of the file contents, memoized by path, size and mtime in cache/hashes.json"""
+    path = os.path.abspath(input_file)
+    key = stat_key(path)
+    index = load_hash_index()
+    entry = index.get(path)
+    if entry and entry[:2] == key:
+        return entry[2]
+
+    digest = file_sha1(path)
+    # Entries of files that are gone or changed would never match again
+    for other in list(index):
+        try:
+            if index[other][:2] != stat_key(other):
+                del index[other]
+        except (OSError, TypeError):
+            del index[other]
+    index[path] = key + [digest]
+    ensure_directory(CACHE_ROOT)
+    tmp = f"{HASH_INDEX}.{os.getpid()}.part"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        replace_file(tmp, HASH_INDEX)
+    except OSError:
+        pass
+    return digest
+
+def get_cache_dir(input_file, digest=None):
+    """Cache entry of a file, keyed by its content so identical files share work across folders"""
+    cache_dir = os.path.join(CACHE_ROOT, (digest or content_hash(input_file))[:16])
     ensure_directory(cache_dir)
     return cache_dir
 
@@ -49,35 +128,9 @@ def scan_models():
     print(json.dumps(missing))
 
 def download_file_with_progress(url, dest_path, label):
-    if os.path.exists(dest_path):
-        return True
-    
-    ensure_directory(os.path.dirname(dest_path))
-    
-    print(f"STATUS: Downloading {label}...")
-    sys.stdout.flush()
-    
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 8192
-        downloaded = 0
-        
-        with open(dest_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=block_size):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0:
-                        percent = int((downloaded / total_size) * 100)
-                        print(f"PROGRESS: {percent}")
-                        sys.stdout.flush()
-    except Exception as e:
-        print(f"ERROR: {str(e)}")
-        sys.stdout.flush()
-        return False
-    return True
+    """Resumable, verified download into dest_path (see downloader.py)"""
+    from downloader import download
+    return download(url, dest_path, label)
 
 def download_models():
     for m in MODELS_CONFIG:
@@ -96,6 +149,21 @@ def load_asmr_dict():
     except:
         return []
 
+def find_prompt_file():
+    """Get the path of the prompt file from prompts directory, or None"""
+    if os.path.exists(PROMPTS_DIR):
+        txt_files = glob.glob(os.path.join(PROMPTS_DIR, "*.txt"))
+        if txt_files:
+            return txt_files[0]
+    if os.path.exists("ReadMe.txt"):
+        return "ReadMe.txt"
+    return None
+
+def find_prompt_file_name():
+    """Get the prompt file name from prompts directory"""
+    prompt_file = find_prompt_file()
+    return os.path.basename(prompt_file) if prompt_file else "default.txt"
+
 def get_assets_context_path(prompt_file_name):
     """Get path for temporary context JSON in assets folder"""
     base_name = os.path.splitext(prompt_file_name)[0]
@@ -117,40 +185,249 @@ def load_temp_dict(prompt_file_name):
     except:
         return []
 
+def collect_input_files(paths):
+    """Expand files and directories into a sorted list of media files"""
+    result = []
+    seen = set()
+    for p in paths:
+        if os.path.isdir(p):
+            found = []
+            for root, _, names in os.walk(p):
+                for name in names:
+                    if os.path.splitext(name)[1].lower() in MEDIA_EXTS:
+                        found.append(os.path.join(root, name))
+            candidates = sorted(found)
+        else:
+            candidates = [p]
+        for c in candidates:
+            abs_path = os.path.abspath(c)
+            if abs_path not in seen:
+                seen.add(abs_path)
+                result.append(abs_path)
+    return result
+
 def get_final_output_path(input_file):
     """Get the final output file path (.lrc or .srt)"""
     input_path = Path(input_file)
     base = input_path.stem
     parent = input_path.parent
     ext = input_path.suffix.lower()
-    is_audio = ext in ['.mp3', '.wav', '.flac', '.m4a', '.aac']
+    is_audio = ext in AUDIO_EXTS
     output_ext = '.lrc' if is_audio else '.srt'
     return str(parent / f"{base}{output_ext}")
 
+class JobContext:
+    """State for one input file that is passed from stage to stage.
+
+    `shared` is reused for every file of a run so that the prompt file lookup,
+    dictionaries and converters are loaded only once per process.
+    """
+
+    def __init__(self, input_file, shared=None):
+        self.input_file = os.path.abspath(input_file)
+        self.shared = shared if shared is not None else {}
+        self.final_output = get_final_output_path(self.input_file)
+        self._input_hash = None
+        self._cache_dir = None
+
+    @property
+    def input_hash(self):
+        """Content hash, read on first use: an input whose output is up to date is never hashed"""
+        if self._input_hash is None:
+            self._input_hash = content_hash(self.input_file)
+        return self._input_hash
+
+    @property
+    def cache_dir(self):
+        if self._cache_dir is None:
+            self._cache_dir = get_cache_dir(self.input_file, self.input_hash)
+        return self._cache_dir
+
+    @property
+    def known_cache_dir(self):
+        """The cache entry if the file's hash is already known, else None"""
+        digest = self._input_hash or memoized_hash(self.input_file)
+        return os.path.join(CACHE_ROOT, digest[:16]) if digest else None
+
+    @property
+    def audio_path(self):
+        # Headerless 16 kHz mono s16le PCM
+        return os.path.join(self.cache_dir, "audio_16k_norm.pcm")
+
+    # Cues as JSON lines (see subtitles.py)
+    @property
+    def raw_path(self):
+        return os.path.join(self.cache_dir, "raw.jsonl")
+
+    @property
+    def corrected_path(self):
+        return os.path.join(self.cache_dir, "corrected.jsonl")
+
+    @property
+    def translated_path(self):
+        return os.path.join(self.cache_dir, "translated.jsonl")
+
+    def cached(self, key, factory):
+        """factory() memoized in the shared dict, built once per key even when stages run in threads"""
+        if key not in self.shared:
+            # dict.setdefault is atomic, so every thread gets the same lock
+            lock = self.shared.setdefault("_locks", {}).setdefault(key, threading.RLock())
+            with lock:
+                if key not in self.shared:
+                    self.shared[key] = factory()
+        return self.shared[key]
+
+    @property
+    def prompt_file(self):
+        return self.cached("prompt_file", find_prompt_file)
+
+    @property
+    def prompt_file_name(self):
+        return self.cached("prompt_file_name", find_prompt_file_name)
+
+    @property
+    def stages(self):
+        from stage_cache import StageCache
+        return StageCache(self.cache_dir)
+
+    @property
+    def readings(self):
+        from reading_cache import ReadingCache
+        return self.cached("readings", ReadingCache)
+
+    @property
+    def asmr_dict(self):
+        return self.cached("asmr_dict", load_asmr_dict)
+
+    @property
+    def temp_dict(self):
+        return self.cached("temp_dict", lambda: load_temp_dict(self.prompt_file_name))
+
+    @property
+    def servers(self):
+        from server_pool import ServerPool
+        return self.cached("server_pool", ServerPool)
+
+    @contextmanager
+    def llm(self, model_path, parallel=1):
+        """LocalLLM on a pooled server with `model_path` loaded, held for the block"""
+        server = self.servers.acquire(model_path, parallel)
+        llm = LocalLLM(port=server.port, pool_size=max(8, parallel))
+        try:
+            yield llm
+        finally:
+            llm.close()
+            self.servers.release(server)
+
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 300))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_RETRY_BACKOFF = 0.5
+LLM_RETRY_STATUS = (500, 502, 503, 504)
+
 class LocalLLM:
-    def __init__(self, port=8080):
-        self.api_url = f"http://127.0.0.1:{port}/completion"
+    """Client for llama-server on a persistent keep-alive connection pool.
+
+    Connection errors and 5xx replies are retried with exponential backoff;
+    a read timeout is not retried so a stalled server fails the request
+    instead of hanging the pipeline.
+    """
 
-    def completion(self, prompt, temperature=0.1, top_p=0.9, max_tokens=1024):
+    def __init__(self, port=8080, connect_timeout=LLM_CONNECT_TIMEOUT, read_timeout=LLM_READ_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES, pool_size=8):
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.api_url = f"{self.base_url}/completion"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self._token_counts = {}
+        self._tokenize_ok = True
+        self._usage = dict(requests=0, prompt_tokens=0, cached_tokens=0, generated_tokens=0, prompt_ms=0.0, generated_ms=0.0)
+        self._usage_lock = threading.Lock()
+
+    def completion(self, prompt, temperature=0.1, top_p=0.9, max_tokens=1024, json_schema=None):
+        """Generated text; with `json_schema` the server's grammar keeps it valid JSON of that schema"""
+        return self.completion_result(prompt, temperature, top_p, max_tokens, json_schema)['content']
+
+    def completion_result(self, prompt, temperature=0.1, top_p=0.9, max_tokens=1024, json_schema=None):
+        """Like completion() but returns the whole server reply (content, tokens_cached, timings, ...)"""
         raw_prompt = f"<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
         if "<|im_start|>" in prompt:
             raw_prompt = prompt
-        return self._send_request(raw_prompt, temperature, top_p, max_tokens, ["<|im_end|>", "###", "[Input]", "[Output]", "<|im_start|>"])
+        result = self._send_request(raw_prompt, temperature, top_p, max_tokens, ["<|im_end|>", "###", "[Input]", "[Output]", "<|im_start|>"], json_schema)
+        timings = result.get('timings') or {}
+        with self._usage_lock:
+            u = self._usage
+            u['requests'] += 1
+            u['prompt_tokens'] += timings.get('prompt_n', 0)
+            u['cached_tokens'] += result.get('tokens_cached', 0)
+            u['generated_tokens'] += timings.get('predicted_n', 0)
+            u['prompt_ms'] += timings.get('prompt_ms', 0.0)
+            u['generated_ms'] += timings.get('predicted_ms', 0.0)
+        return result
+
+    def usage(self):
+        """Totals over all completions so far; prompt tokens exclude the ones reused from the KV cache"""
+        with self._usage_lock:
+            return dict(self._usage)
 
-    def _send_request(self, prompt, temperature, top_p, max_tokens, stop_tokens):
+    def count_tokens(self, text):
+        """Token count of `text` from the server's /tokenize endpoint, cached per text.
+
+        Counts only shape batches, so /tokenize is not retried; after it fails
+        once every count is the estimate instead.
+        """
+        count = self._token_counts.get(text)
+        if count is None:
+            if self._tokenize_ok:
+                try:
+                    count = len(self._post("/tokenize", {"content": text}, max_retries=0).get("tokens", []))
+                except Exception:
+                    self._tokenize_ok = False
+            if count is None:
+                # Rough fallback: about one token per Japanese character
+                count = len(text)
+            self._token_counts[text] = count
+        return count
+
+    async def acompletion(self, prompt, temperature=0.1, top_p=0.9, max_tokens=1024, json_schema=None):
+        """Awaitable completion for use inside an event loop; runs on the same connection pool"""
+        return await asyncio.to_thread(self.completion, prompt, temperature, top_p, max_tokens, json_schema)
+
+    def close(self):
+        self.session.close()
+
+    def _send_request(self, prompt, temperature, top_p, max_tokens, stop_tokens, json_schema=None):
         payload = {
             "prompt": prompt,
             "temperature": temperature,
             "top_p": top_p,
             "n_predict": max_tokens,
-            "stop": stop_tokens
+            "stop": stop_tokens,
+            # Reuse the KV cache of the longest common prompt prefix
+            "cache_prompt": True
         }
-        try:
-            response = requests.post(self.api_url, json=payload)
-            response.raise_for_status()
-            return response.json()['content']
-        except Exception as e:
-            raise
+        if json_schema is not None:
+            payload["json_schema"] = json_schema
+        return self._post("/completion", payload)
+
+    def _post(self, path, payload, max_retries=None):
+        url = self.base_url + path
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            retry = attempt < max_retries
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                if not (retry and response.status_code in LLM_RETRY_STATUS):
+                    response.raise_for_status()
+                    return response.json()
+            except requests.ConnectionError:
+                if not retry:
+                    raise
+            time.sleep(LLM_RETRY_BACKOFF * (2 ** attempt))
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
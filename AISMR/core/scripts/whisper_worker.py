@@ -0,0 +1,54 @@
+import os
+import sys
+import subprocess
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "_1_whisper.py")
+
+class WhisperWorker:
+    """Client for a long-lived `_1_whisper.py --worker` process"""
+
+    def __init__(self):
+        self.process = None
+
+    def start(self):
+        print("Starting Whisper worker...", flush=True)
+        self.process = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, "--worker"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
+            env=os.environ.copy()
+        )
+
+    def transcribe(self, input_file):
+        """Send one job to the worker and relay its output until the job finishes"""
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        try:
+            self.process.stdin.write(input_file + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            self.stop()
+            return False
+
+        for line in self.process.stdout:
+            if line.startswith("JOB_DONE:"):
+                return line.split()[1] == "ok"
+            print(line, end="", flush=True)
+
+        # Worker exited mid-job
+        self.stop()
+        return False
+
+    def stop(self):
+        if not self.process:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+        self.process = None
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline scripts import each other by module name
+scripts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+if scripts_dir not in sys.path:
+    sys.path.insert(0, scripts_dir)
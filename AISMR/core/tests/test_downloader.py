@@ -0,0 +1,69 @@
+"""downloader.download() against the local model host stand-in from benchmark.py"""
+import os
+import pytest
+import downloader
+from benchmark import ModelHost, fetch_model
+
+SEGMENTS = 4
+DATA = os.urandom(8 << 20)
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    # Several segments on a small file
+    monkeypatch.setattr(downloader, "MIN_SEGMENT", 1 << 20)
+
+@pytest.fixture
+def host():
+    hosts = []
+
+    def make(**kwargs):
+        hosts.append(ModelHost(DATA, **kwargs))
+        return hosts[-1]
+    yield make
+    for h in hosts:
+        h.close()
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize("segments", [1, SEGMENTS])
+def test_survives_dropped_connections(tmp_path, host, segments):
+    dest = str(tmp_path / "model.gguf")
+    ok, _, lines = fetch_model(host(drops=2), "/resolve", dest, segments)
+    assert ok and read(dest) == DATA
+    assert sum(line.startswith("PROGRESS:") for line in lines) <= 101
+
+def test_interrupted_download_resumes(tmp_path, host, monkeypatch):
+    dest = str(tmp_path / "model.gguf")
+    server = host(drops=SEGMENTS)
+    monkeypatch.setattr(downloader, "RETRIES", 0)
+    ok, _, _ = fetch_model(server, "/resolve", dest, SEGMENTS)
+    assert not ok and not os.path.exists(dest) and os.path.exists(dest + ".part.json")
+
+    monkeypatch.setattr(downloader, "RETRIES", 5)
+    first = server.sent
+    ok, _, _ = fetch_model(server, "/resolve", dest, SEGMENTS)
+    assert ok and read(dest) == DATA
+    # Only what the interrupted attempt missed is fetched again
+    assert server.sent - first < len(DATA)
+    assert not os.path.exists(dest + ".part") and not os.path.exists(dest + ".part.json")
+
+def test_expired_signed_url_is_renewed(tmp_path, host):
+    dest = str(tmp_path / "model.gguf")
+    # Every segment outlives its signed URL once, after dropping halfway
+    server = host(drops=SEGMENTS, expire_every=SEGMENTS)
+    ok, _, _ = fetch_model(server, "/resolve", dest, SEGMENTS)
+    assert ok and read(dest) == DATA
+    assert server.expired > 0
+
+def test_sha256_mismatch_is_rejected(tmp_path, host):
+    dest = str(tmp_path / "model.gguf")
+    ok, _, lines = fetch_model(host(sha256="0" * 64), "/resolve", dest, SEGMENTS)
+    assert not ok and any(line.startswith("ERROR:") for line in lines)
+    assert not os.path.exists(dest) and not os.path.exists(dest + ".part")
+
+def test_server_without_range_support(tmp_path, host):
+    dest = str(tmp_path / "model.gguf")
+    ok, _, _ = fetch_model(host(), "/plain", dest, SEGMENTS)
+    assert ok and read(dest) == DATA
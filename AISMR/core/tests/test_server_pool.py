@@ -0,0 +1,33 @@
+"""ServerPool against the stand-in llama-server from benchmark.py"""
+import pytest
+from benchmark import free_port, pool_run, stub_llama
+from server_pool import ServerPool, estimate_bytes
+
+ROUNDS = 3
+PARALLEL = 2
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    exe, models = stub_llama(str(tmp_path), 0.1)
+    monkeypatch.setenv("LLAMA_SERVER_BIN", exe)
+    plan = [(models[i % 2], 1 if i % 2 == 0 else PARALLEL) for i in range(2 * ROUNDS)]
+    fits_both = sum(estimate_bytes(m, p) for m, p in set(plan))
+    port = free_port()
+
+    def pool(budget):
+        return ServerPool(budget=budget, base_port=port, state_dir=str(tmp_path))
+    return pool, plan, fits_both
+
+def test_one_model_at_a_time(setup):
+    pool, plan, _ = setup
+    assert pool_run(pool(0), plan)[:2] == (len(plan), 0)
+
+def test_budget_keeps_both_models(setup):
+    pool, plan, fits_both = setup
+    assert pool_run(pool(fits_both), plan)[:2] == (2, 0)
+
+def test_kept_alive_server_is_reused_by_next_run(setup):
+    pool, plan, fits_both = setup
+    # Only Sakura is kept alive; the next run starts Qwen first and must not take its port
+    assert pool_run(pool(fits_both), plan[1:2], keep_alive=True)[:2] == (1, 0)
+    assert pool_run(pool(fits_both), plan)[:2] == (1, 1)
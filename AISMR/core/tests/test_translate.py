@@ -0,0 +1,31 @@
+"""Parallel translation batches against the stand-in llama-server from benchmark.py"""
+import contextlib
+import io
+import pytest
+import _3_translate
+from benchmark import free_port, stub_llama, translate_timed
+from server_pool import ServerPool
+
+LINES = 80
+PARALLEL = 4
+LATENCY = 0.2
+
+@pytest.fixture
+def translate(tmp_path, monkeypatch):
+    exe, models = stub_llama(str(tmp_path), 0.1, LATENCY)
+    monkeypatch.setenv("LLAMA_SERVER_BIN", exe)
+    pool = ServerPool(budget=0, base_port=free_port(), state_dir=str(tmp_path))
+    yield lambda batches, parallel: translate_timed(pool, models[1], batches, parallel)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool.close()
+
+def test_slots_keep_order_and_scale(translate):
+    lines = [{"text": f"台詞{i}です"} for i in range(LINES)]
+    batches = [lines[i:i + _3_translate.BATCH_SIZE] for i in range(0, LINES, _3_translate.BATCH_SIZE)]
+    expected = ["译" + item["text"] for item in lines]
+    sequential, t_sequential = translate(batches, 1)
+    parallel, t_parallel = translate(batches, PARALLEL)
+    assert sequential == expected
+    assert parallel == expected
+    # Ideal is PARALLEL; allow for thread and HTTP overhead
+    assert t_sequential / t_parallel >= PARALLEL * 0.6
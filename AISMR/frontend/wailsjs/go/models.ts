@@ -2,6 +2,7 @@ export namespace main {
 	
 	export class AppConfig {
 	    cacheStrategy: string;
+	    cacheBudgetMB: number;
 	
 	    static createFrom(source: any = {}) {
 	        return new AppConfig(source);
@@ -10,6 +11,7 @@ export namespace main {
 	    constructor(source: any = {}) {
 	        if ('string' === typeof source) source = JSON.parse(source);
 	        this.cacheStrategy = source["cacheStrategy"];
+	        this.cacheBudgetMB = source["cacheBudgetMB"];
 	    }
 	}
 	export class FileItem {